@@ -27,14 +27,39 @@ import pickle
 import time
 import json
 from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
 
 from .data_society import Society, webSociety
-from .input_functions import get_project_dict, _Minimal_Sample_Number
+from .community_detection import CommunityMembership
+from .input_functions import get_project_dict, read_input_tables, _Minimal_Sample_Number, NUM_PERMUTATION
 
-from .pls2_network import pairNetwork
+from .pls2_network import pairNetwork, NullDistributionCache, NullDistributionStore, size_pair_scores
+from .shared_data import share_society, society_values, attach_society, share_arrays, attach_arrays, release_blocks
+from .cache import array_digest, key_digest
 from .html_visual import make_js_from_network, make_html_page
 
 
+# null cache of a worker process in HiCoNet.schedule_associations,
+# holding the permutation scores precomputed by the parent process in shared memory
+_worker_null_cache = []
+
+def _init_worker_null_cache(cache_dir, descriptor, keys):
+    null_cache = NullDistributionStore(cache_dir) if cache_dir else NullDistributionCache()
+    arrays, blocks = attach_arrays(descriptor)
+    for key in keys:
+        null_cache.scores[key] = arrays[key_digest(*key)]
+    _worker_null_cache[:] = [null_cache, blocks]
+
+def _worker_pair_networks(associations, descriptor1, descriptor2, options):
+    # associations of one society pair, in order, sharing the null cache of this worker
+    return [pairNetwork(A, attach_society(descriptor1), attach_society(descriptor2), 
+                        n_jobs=1, null_cache=_worker_null_cache[0], **options) for A in associations]
+
+def _worker_build_society(sd, workdir, cache_dir, tables):
+    return Society(sd, workdir, cache_dir, tables=tables)
+
+
 class HiCoNet:
     """
     Hirarchical community network.
@@ -54,10 +79,38 @@ class HiCoNet:
     Output formats can be
     JSON, pickle and local file writes.
 
+    Computing options, n_jobs (number of processes), society_jobs (workers to build societies, default n_jobs), 
+    seed (random seed), num_permutation, p_value_method, adaptive_permutation, max_permutation, null_mode and cache_dir, 
+    are taken from arguments or from the project dictionary.
+    With adaptive_permutation, each community pair is tested by sequential permutation against the null 
+    of its own community size pair, whereas the fixed num_permutation test uses the null pooled over 
+    all size pairs of an association; p-values of the two modes are thus not directly comparable.
+    If cache_dir is given (relative to workdir), parsed tables, permutation scores and communities 
+    are kept on disk across runs; if no seed is given, the seed saved in cache_dir is used.
+
     """
-    def __init__(self, dict_project_definition):
+    def __init__(self, dict_project_definition, n_jobs=None, seed=None, cache_dir=None):
         
         self.dict_project_definition = dict_project_definition
+        self.n_jobs = n_jobs or dict_project_definition.get('n_jobs', 1)
+        self.society_jobs = dict_project_definition.get('society_jobs', self.n_jobs)
+        self.num_permutation = dict_project_definition.get('num_permutation', NUM_PERMUTATION)
+        self.p_value_method = dict_project_definition.get('p_value_method', 'polyfit')
+        self.adaptive_permutation = dict_project_definition.get('adaptive_permutation', False)
+        self.max_permutation = dict_project_definition.get('max_permutation', 10000)
+        self.null_mode = dict_project_definition.get('null_mode', 'resample')
+        self.cache_dir = cache_dir or dict_project_definition.get('cache_dir', None)
+        if self.cache_dir:
+            self.cache_dir = os.path.join(dict_project_definition.get('workdir', ''), self.cache_dir)
+            self.null_cache = NullDistributionStore(self.cache_dir)
+        else:
+            self.null_cache = NullDistributionCache()
+        # resolved once, so that all pairNetworks share one seed and one null cache;
+        # without a given seed, a persistent null cache keeps its own seed to be reused across runs
+        seed = seed if seed is not None else dict_project_definition.get('seed', None)
+        if seed is None and self.cache_dir:
+            seed = self.null_cache.default_seed()
+        self.seed = np.random.SeedSequence(seed).entropy
         
         # get self.societies and self.society_dict
         self.societies = []
@@ -192,27 +245,172 @@ class HiCoNet:
         association_dict contains how the association is to be computed: matching samples etc.
         
         pn.network_edges = [( g, m, PLSscore, p-value ), ...]
+        Permutation scores are shared via self.null_cache by associations of the same societies.
+        With n_jobs > 1 and several associations, these are run concurrently by schedule_associations;
+        otherwise each pairNetwork uses n_jobs for its own permutation.
         """
+        valid = []
         for A in self.dict_project_definition['associations']:
             if len(A['subjects']) > _Minimal_Sample_Number:
-                print("\n############################\n\n")
-                print(A)
-                pn = pairNetwork(A, self.society_dict[A['society1']], self.society_dict[A['society2']])
-                self.networks.append( pn )
-                self.network_dict[pn.name] = pn
-                 
+                valid.append(A)
             else:
                 print("Dropped %s, fewer samples than minimal requirement." %A['name'])
 
+        if self.n_jobs > 1 and len(valid) > 1:
+            networks = self.schedule_associations(valid)
+        else:
+            networks = []
+            for A in valid:
+                print("\n############################\n\n")
+                print(A)
+                networks.append(pairNetwork(A, self.society_dict[A['society1']], self.society_dict[A['society2']], 
+                                            n_jobs=self.n_jobs, null_cache=self.null_cache, 
+                                            **self.pair_network_options()))
+
+        for pn in networks:
+            self.networks.append( pn )
+            self.network_dict[pn.name] = pn
+
+    def pair_network_options(self):
+        """
+        Options passed to every pairNetwork, except n_jobs and null_cache.
+        """
+        return {'seed': self.seed, 
+                'numPermutation': self.num_permutation, 
+                'p_value_method': self.p_value_method, 
+                'adaptive': self.adaptive_permutation, 
+                'maxPermutation': self.max_permutation, 
+                'null_mode': self.null_mode,
+                }
+
+    def estimate_association_cost(self, A):
+        """
+        Relative cost of a pairNetwork: 
+        number of community pairs x mean block size x samples x (permutation rounds + 1).
+        """
+        sizes1 = CommunityMembership.from_dict(self.society_dict[A['society1']].Communities).sizes
+        sizes2 = CommunityMembership.from_dict(self.society_dict[A['society2']].Communities).sizes
+        sizes1, sizes2 = sizes1[sizes1 > 2], sizes2[sizes2 > 2]
+        if not sizes1.size or not sizes2.size:
+            return 0
+        return len(sizes1) * len(sizes2) * (np.mean(sizes1) + np.mean(sizes2)) \
+                * len(A['observation_list_society1']) * (self.num_permutation + 1)
+
+    def schedule_associations(self, associations):
+        """
+        Run pairNetworks of associations concurrently on a pool of self.n_jobs processes.
+        Jobs are submitted by estimated cost, longest first, 
+        and results are returned in the order of associations, whatever the order of completion.
+        With adaptive permutation, associations sharing a null are grouped into one job.
+
+        Permutation scores are computed once for all associations (see precompute_null_distributions),
+        and given to the null cache of each worker process in shared memory; 
+        workers only compute additional rounds of adaptive permutation.
+        Results do not depend on the worker a job runs on, as permutation streams are tied to self.seed.
+
+        Society data are placed in shared memory once (see shared_data.share_society);
+        workers attach to them, and only association dicts and small descriptors are sent per job.
+        """
+        # with adaptive permutation, associations sharing a null (society pair and sample number) 
+        # are run in one job, so that their additional rounds are computed once
+        groups = {}
+        for ii, A in enumerate(associations):
+            key = (A['society1'], A['society2'], len(A['observation_list_society1'])) \
+                    if self.adaptive_permutation and self.null_mode == 'resample' else ii
+            groups.setdefault(key, []).append(ii)
+        order = sorted(groups.values(), 
+                       key=lambda group: sum(self.estimate_association_cost(associations[ii]) for ii in group), 
+                       reverse=True)
+        print("Scheduling %d associations in %d jobs on %d processes." %(len(associations), len(order), self.n_jobs))
+        networks = [None] * len(associations)
+        descriptors, blocks = {}, []
+        try:
+            for A in associations:
+                for name in (A['society1'], A['society2']):
+                    if name not in descriptors:
+                        descriptors[name], new_blocks = share_society(self.society_dict[name])
+                        blocks += new_blocks
+            null_descriptor, null_keys, new_blocks = self.precompute_null_distributions(associations)
+            blocks += new_blocks
+            with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker_null_cache, 
+                                     initargs=(self.cache_dir, null_descriptor, null_keys)) as executor:
+                futures = {}
+                for group in order:
+                    A = associations[group[0]]
+                    futures[executor.submit(_worker_pair_networks, [associations[ii] for ii in group], 
+                                            descriptors[A['society1']], descriptors[A['society2']], 
+                                            self.pair_network_options())] = group
+                for future in as_completed(futures):
+                    for ii, pn in zip(futures[future], future.result()):
+                        networks[ii] = pn
+                        print("Finished association %s." %pn.name)
+        finally:
+            release_blocks(blocks)
+
+        return networks
+
+
+    def precompute_null_distributions(self, associations):
+        """
+        Permutation scores of all associations in 'resample' null_mode, on a pool of self.n_jobs processes.
+        Each null, i.e. value pools, SampleNumber, seed and community size pair, is computed once into 
+        self.null_cache, rather than by every worker whose associations share it.
+        With adaptive permutation, this is the first batch of rounds.
+
+        Returns
+        -------
+        descriptor of the scores in shared memory, keys of self.null_cache, 
+        and list of SharedMemory blocks to release after use.
+        """
+        if self.null_mode != 'resample':
+            return {}, [], []
+        numPermutation = self.num_permutation
+        if self.adaptive_permutation:
+            numPermutation = min(self.num_permutation, self.max_permutation)
+        pools, digests, sizes = {}, {}, {}
+        wanted = {}
+        for A in associations:
+            for name in (A['society1'], A['society2']):
+                if name not in digests:
+                    # value pools as seen by pairNetwork in workers
+                    pool = society_values(self.society_dict[name]).ravel()
+                    digests[name] = array_digest(pool)
+                    pools[digests[name]] = pool
+                    community_sizes = CommunityMembership.from_dict(self.society_dict[name].Communities).sizes
+                    sizes[name] = sorted(set(community_sizes[community_sizes > 2].tolist()))
+            null_key = (digests[A['society1']], digests[A['society2']], 
+                        len(A['observation_list_society1']), self.seed)
+            for g in sizes[A['society1']]:
+                for m in sizes[A['society2']]:
+                    wanted[null_key + (g, m)] = numPermutation
+
+        print("Computing permutation scores of %d associations on %d processes." %(len(associations), self.n_jobs))
+        scores = size_pair_scores(wanted, pools, self.null_cache, self.n_jobs)
+        descriptor, blocks = share_arrays(dict((key_digest(*key), S) for key, S in scores.items()))
+        return descriptor, list(scores), blocks
+
 
     def get_Societies(self):
         """
         Generate a list and dictionary of societies.
+        With society_jobs > 1, input files are read on a thread pool, 
+        then societies (data cleanup and community detection) are built on a pool of processes.
         """
-        for sd in self.dict_project_definition['societies']:
-            if sd['file_data_matrix']:
+        workdir = self.dict_project_definition['workdir']
+        society_dicts = [sd for sd in self.dict_project_definition['societies'] 
+                         if sd.get('file_data_matrix') or sd.get('file_long_table')]
+        if self.society_jobs > 1 and len(society_dicts) > 1:
+            workers = min(self.society_jobs, len(society_dicts))
+            print("Building %d societies on %d processes." %(len(society_dicts), workers))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                tables = list(pool.map(lambda sd: read_input_tables(workdir, sd, self.cache_dir), society_dicts))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                self.societies += list(pool.map(_worker_build_society, society_dicts, [workdir] * len(society_dicts), 
+                                                [self.cache_dir] * len(society_dicts), tables))
+        else:
+            for sd in society_dicts:
                 print("Working on {}".format(sd))
-                self.societies.append(Society(sd, self.dict_project_definition['workdir']))
+                self.societies.append(Society(sd, workdir, self.cache_dir))
 
         self.society_dict = {}
         for sc in self.societies:
@@ -248,12 +446,13 @@ class HiCoNet:
         Write all network edges, and a separate file for top networks.
         But the top networks use composite community IDs.
         """
-        header = "datatype_1\tdatatype_2\tcommunity1_number\tcommunity2_number\tPLS_score\tp-value\n"
+        header = "datatype_1\tdatatype_2\tcommunity1_number\tcommunity2_number\tPLS_score\tp-value\tpermutations\n"
         for pn in self.networks:
             s = header
             for e in pn.network_edges:
                 # pn.network_edges = [( g, m, PLSscore, p-value ), ...]
-                s += '\t'.join( [pn.dict['society1'], pn.dict['society2']] + [str(x) for x in e]) + '\n'
+                s += '\t'.join( [pn.dict['society1'], pn.dict['society2']] + [str(x) for x in e] 
+                                + [str(pn.permutation_counts[(e[0], e[1])])] ) + '\n'
 
             with open(os.path.join(self.outdir_individual_networks, pn.name + "_network.txt"), "w") as O:
                 O.write(s)
@@ -330,7 +529,7 @@ class HiCoNet:
 
         for sc in self.societies:
             for c, L in sc.Communities.items():
-                # Communities is a dictionary {community_ID: [feature_index, ...], ...}
+                # Communities is a CommunityMembership, {community_ID: array of feature_index, ...}
                 for T in sc.timepoints:
                     n = '.'.join((sc.name, str(c), str(T)))
                     # Only export data in use
@@ -340,7 +539,7 @@ class HiCoNet:
                         for ii in range(len(L)):
                             feature_name = sc.feature_member_annotation[L[ii]]
                             M.append(feature_name)
-                            D.append({'name': feature_name, 'data': list(nested_data_list[ii])})
+                            D.append({'name': feature_name, 'data': nested_data_list[ii].tolist()})
                             
                         community_members[n] = M
                         # To make this specific to time point in future, using pn.dict['observation_list_society1']
@@ -0,0 +1,91 @@
+"""Hieracrchical Community Network - caching
+
+Content digests and file helpers for on-disk caches.
+All caches of a project live under one cache directory (`cache_dir` in project.yaml),
+each in its own subdirectory.
+
+Cached arrays are saved as .npy files and memory-mapped when read again,
+or, for small sets of arrays, as one .npz file.
+Files are written to a unique temporary name then renamed (write_atomic),
+so that concurrent processes or threads never read a partial file, nor write the same temporary file.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+def array_digest(A):
+    """
+    SHA1 hex digest of the contents, shape and dtype of an array.
+    """
+    A = np.ascontiguousarray(A)
+    h = hashlib.sha1(repr((A.dtype.str, A.shape)).encode())
+    h.update(A.data)
+    return h.hexdigest()
+
+
+def key_digest(*parts):
+    """
+    SHA1 hex digest of a tuple of simple values (str, int, float, tuple), used as file name.
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def get_cache_subdir(cache_dir, name):
+    """
+    Return path of a cache subdirectory, created if not existing.
+    """
+    path = os.path.join(cache_dir, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_atomic(path, write, mode='wb'):
+    """
+    Write a file by write(F) on a temporary file in the same directory, then rename it to path.
+    The temporary file is unique (tempfile.mkstemp), and removed if write fails.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as O:
+            write(O)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def save_array(path, A):
+    """
+    Write array to .npy file via a temporary file.
+    """
+    write_atomic(path, lambda O: np.save(O, A))
+
+
+def load_array(path, mmap_mode='r'):
+    """
+    Memory-map a .npy file; returns None if not found.
+    """
+    if os.path.exists(path):
+        return np.load(path, mmap_mode=mmap_mode)
+    return None
+
+
+def save_arrays(path, **arrays):
+    """
+    Write arrays to one compressed .npz file via a temporary file.
+    """
+    write_atomic(path, lambda O: np.savez_compressed(O, **arrays))
+
+
+def load_arrays(path):
+    """
+    Read all arrays of a .npz file as {name: array}; returns None if not found.
+    """
+    if os.path.exists(path):
+        with np.load(path) as F:
+            return {k: F[k] for k in F.files}
+    return None
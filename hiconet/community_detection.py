@@ -22,38 +22,134 @@ input dataframe has to be correctly read: values start at position [0,0].
 
 """
 
-__all__ = ["hierachical_clustering", "hierachical_clustering_lcms",
+__all__ = ["CommunityMembership",
+           "hierachical_clustering", "hierachical_clustering_lcms", "correlation_distance",
+           "lcms_rt_window_communities", "split_large_communities",
            #"louvain_find_communities",
-           "leiden_find_communities",
+           "leiden_find_communities", "leiden_resolution_sweep",
             # to add other methods
           ]
 
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
+from scipy import sparse
 from scipy.cluster.hierarchy import *
-from scipy.spatial.distance import pdist
+import igraph
+import leidenalg
 
-import scanpy as sc
-import anndata
 
+class CommunityMembership:
+    """
+    Compact community membership, in CSR layout:
+    labels, array of community IDs;
+    members of labels[i] are feature indices indices[indptr[i]: indptr[i+1]].
 
-def hierachical_clustering(df, distanceCut = 2):
+    It behaves as the dictionary {community_ID: array of feature_index, ...}, 
+    with keys, values, items, len, iteration and lookup by community ID;
+    members are returned as views into indices.
+    """
+    def __init__(self, labels, indptr, indices):
+        self.labels = np.asarray(labels)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self._position = dict((c, ii) for ii, c in enumerate(self.labels.tolist()))
+
+    @classmethod
+    def from_membership(cls, Clus):
+        """
+        Group features by community, from Clus = [feature_community_ID, ...].
+        Communities are ordered by first appearance in Clus, and members by feature index, 
+        as in the dictionaries built by a loop over features.
+        """
+        labels, first, inverse = np.unique(np.asarray(Clus), return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        inverse = np.argsort(order)[inverse.ravel()]
+        counts = np.bincount(inverse, minlength=labels.size)
+        return cls(labels[order], np.concatenate(([0], np.cumsum(counts))), np.argsort(inverse, kind='stable'))
+
+    @classmethod
+    def from_dict(cls, Communities):
+        """
+        From {community_ID: [feature_index, ...], ...}, or another CommunityMembership.
+        """
+        if isinstance(Communities, cls):
+            return Communities
+        labels = list(Communities.keys())
+        members = [np.asarray(Communities[c], dtype=np.int64) for c in labels]
+        return cls(labels, np.concatenate(([0], np.cumsum([x.size for x in members], dtype=np.int64))), 
+                   np.concatenate(members) if members else np.zeros(0, dtype=np.int64))
+
+    @property
+    def sizes(self):
+        return np.diff(self.indptr)
+
+    def __getitem__(self, c):
+        ii = self._position[c]
+        return self.indices[self.indptr[ii]: self.indptr[ii + 1]]
+
+    def __contains__(self, c):
+        return c in self._position
+
+    def __len__(self):
+        return self.labels.size
+
+    def __iter__(self):
+        return iter(self._position)
+
+    def keys(self):
+        return self._position.keys()
+
+    def values(self):
+        return [self[c] for c in self._position]
+
+    def items(self):
+        return [(c, self[c]) for c in self._position]
+
+    def get(self, c, default=None):
+        return self[c] if c in self._position else default
+
+    def to_dict(self):
+        return dict((c, self[c].tolist()) for c in self._position)
+
+    def __eq__(self, other):
+        # as dict equality: same community IDs with the same members, regardless of community order
+        if isinstance(other, dict):
+            other = CommunityMembership.from_dict(other)
+        if not isinstance(other, CommunityMembership):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __getstate__(self):
+        return {'labels': self.labels, 'indptr': self.indptr, 'indices': self.indices}
+
+    def __setstate__(self, state):
+        self.__init__(state['labels'], state['indptr'], state['indices'])
+
+    def __repr__(self):
+        return "CommunityMembership(%d communities, %d features)" %(len(self), self.indices.size)
+
+
+def hierachical_clustering(df, distanceCut = 2, dtype=np.float64):
     """Finding communities by hierachical clustering then cutting dendrogram tree.
     
     Parameters
     ----------
     df: input dataframe (data matrix)
     distanceCut is used to cut dendrogram tree. This can be optimized.
+    dtype: of the correlation distance (see correlation_distance). np.float64 has lower peak memory, 
+           as scipy linkage works on a float64 copy of a float32 distance vector
 
     Returns
     -------
     Clus: list of membership
-    ClusDict: dictionary of communities to members
+    ClusDict: CommunityMembership, communities to members
     """
 
     # distance matrix
     # print (df.values[:2, 1:5])
     # Y = pdist(df.values[:, 1:], 'correlation')
-    Y = pdist(df.values, 'correlation')
+    Y = correlation_distance(df.values, dtype)
     print(df.shape, Y.shape)
 
     # linkage matrix
@@ -67,13 +163,7 @@ def hierachical_clustering(df, distanceCut = 2):
     print("number of communities: ", number_clusters)
 
     # Compile clusters
-    ClusDict = {}
-    for ii in range(number_features):
-        # if ClusDict.has_key(Clus[ii]):
-        if Clus[ii] in ClusDict:
-            ClusDict[ Clus[ii] ].append(ii)
-        else:
-            ClusDict[ Clus[ii] ] = [ii]
+    ClusDict = CommunityMembership.from_membership(Clus)
 
     #print(ClusDict.items()[:3])    # This organizes cluster, members
     return Clus, ClusDict
@@ -87,45 +177,104 @@ def girvan_newton_spectral_clustering():
     pass
 
 
-def hierachical_clustering_lcms(DataMatrix, FeatureAnnotation, distanceCut = 3):
+def correlation_distance(values, dtype=np.float64, block_size=256):
+    """
+    Condensed correlation distance, 1 - PearsonR between rows, as pdist(values, 'correlation').
+    Rows are standardized once, then the distance is computed by blocks of rows 
+    with matrix products (BLAS GEMM) into one preallocated condensed vector.
+    Rows of zero variance get distance 1.
+
+    Parameters
+    ----------
+    values: data matrix as array, features as rows
+    dtype: np.float64, or np.float32 to halve the memory of the distance vector itself;
+           not for linkage, which makes a float64 copy (peak memory of float32 + float64 vectors)
+    block_size: number of rows per matrix product
+
+    Returns
+    -------
+    condensed distance vector in dtype, as input to linkage
+    """
+    Z = np.array(values, dtype=np.float64)
+    Z -= Z.mean(axis=1, keepdims=True)
+    norm = np.sqrt((Z**2).sum(axis=1, keepdims=True))
+    norm[norm == 0] = 1
+    Z /= norm
+    Z = Z.astype(dtype, copy=False)
+    n = Z.shape[0]
+    D = np.empty(n * (n - 1) // 2, dtype=dtype)
+    for i0 in range(0, n, block_size):
+        i1 = min(n, i0 + block_size)
+        S = Z[i0:i1] @ Z[i0:].T
+        for ii in range(i0, i1):
+            # condensed position of pair (ii, ii+1)
+            start = ii * n - ii * (ii + 1) // 2
+            np.subtract(1, S[ii - i0, ii - i0 + 1:], out=D[start: start + n - ii - 1])
+    return D
+
+
+def rt_weighted_distance(values, retention_time, dtype=np.float64):
+    """
+    Condensed distance weighting retention time into correlation distance,
+    distance = 1 - (1 - delta_RT/range_retention_time)*PearsonR,
+    computed in place in the condensed correlation distance vector, one row segment at a time.
+
+    Parameters
+    ----------
+    values: data matrix as array, features as rows
+    retention_time: array of retention time per row
+    dtype: of the distance vector (see correlation_distance).
+           Note that scipy linkage works on a float64 copy, so np.float32 does not reduce peak memory of clustering.
+
+    Returns
+    -------
+    condensed distance vector, as input to linkage
+    """
+    retention_time = np.asarray(retention_time, dtype=np.float64)
+    range_retention_time = retention_time.max() - retention_time.min()
+    D = correlation_distance(values, dtype)
+
+    n = values.shape[0]
+    weight = np.empty(n, dtype=D.dtype)
+    start = 0
+    for ii in range(n - 1):
+        segment, w = D[start: start + n - ii - 1], weight[: n - ii - 1]
+        # w = 1 - delta_RT/range_retention_time; segment becomes 1 - w * (1 - segment)
+        np.subtract(retention_time[ii + 1:], retention_time[ii], out=w, casting='same_kind')
+        np.abs(w, out=w)
+        w /= range_retention_time
+        np.subtract(1, w, out=w)
+        np.subtract(1, segment, out=segment)
+        segment *= w
+        np.subtract(1, segment, out=segment)
+        start += n - ii - 1
+    return D
+
+
+def hierachical_clustering_lcms(DataMatrix, FeatureAnnotation, distanceCut = 3, dtype=np.float64):
     """Clustering of LC-MS data by considering retention time.
     This uses the trio data structure
     
     Metabolomics FeatureAnnotation must have columns 'mz', 'rtime'.
+    The weighted distance is computed in place by rt_weighted_distance;
+    dtype np.float64 is recommended, as linkage copies a np.float32 distance to float64, raising peak memory.
     
     porting into HiCoNet
     """
 
     # Clustering of metabolite features
-    # distance matrix, this is [1 - (Pearson R)]
+    # distance matrix, this is [1 - (Pearson R)], weighted by delta retention time
     metabo = DataMatrix
-    YM = pdist(metabo.values[:, 1:], 'correlation')
-    print(metabo.shape, YM.shape)
-
-    # New method, weighting delta retention time into new distance matrix
-    retention_time = [FeatureAnnotation.loc[x, 'rtime'] for x in metabo.index]         
     # Note this relies on correct reading table; index is mz_rt
-    min_retention_time, max_retention_time = min(retention_time), max(retention_time)
-    range_retention_time = max_retention_time - min_retention_time
-    print("min_retention_time, max_retention_time", min_retention_time, max_retention_time)
-
-
-    PearsonR = 1 - YM
-    #print(PearsonR[:20])
-
-    delta_RT = []
-    for ii in range(metabo.shape[0]):
-        for jj in range(ii+1, metabo.shape[0]):
-            delta_RT.append(abs(retention_time[ii] - retention_time[jj]))
-
-    print("Vector delta_RT len: ", len(delta_RT))
+    retention_time = FeatureAnnotation.loc[metabo.index, 'rtime'].values
+    print("min_retention_time, max_retention_time", retention_time.min(), retention_time.max())
 
     #
     # weighting function
     # distance = 1 - (1 - delta_RT/range_retention_time)*PearsonR
     #
-
-    YM_new = 1 - (1- np.array(delta_RT)/range_retention_time)*PearsonR
+    YM_new = rt_weighted_distance(metabo.values[:, 1:], retention_time, dtype)
+    print(metabo.shape, YM_new.shape)
     ZM = linkage(YM_new, method='ward')
     metClus = fcluster(ZM, distanceCut, criterion='distance')
     #print(metClus[:10])
@@ -135,40 +284,396 @@ def hierachical_clustering_lcms(DataMatrix, FeatureAnnotation, distanceCut = 3):
     print("number of communities: ", number_clusters)
 
     # Compile clusters
-    metClusDict = {}
-    for ii in range(number_features):
-        # if metClusDict.has_key(metClus[ii]):
-        if metClus[ii] in metClusDict:
-            metClusDict[ metClus[ii] ].append(ii)
-        else:
-            metClusDict[ metClus[ii] ] = [ii]
+    metClusDict = CommunityMembership.from_membership(metClus)
 
     return metClus, metClusDict
 
 
-def leiden_find_communities(df, method='modularity'):
+def split_large_communities(values, Clus, max_community_size, dtype=np.float64):
+    """
+    Split communities larger than max_community_size, to bound the cost of PLS per community pair.
+    An oversized community is clustered again (ward linkage on correlation_distance of its members)
+    into ceil(size/max_community_size) sub-communities, recursively until all fit.
+    Sub-community IDs are hierarchical, e.g. '3_1', '3_2', and '3_2_1' if '3_2' is split again;
+    all community IDs become strings once any community is split.
+
+    Parameters
+    ----------
+    values: data matrix as array, features as rows
+    Clus: list of membership
+    max_community_size: maximal number of features per community
+
+    Returns
+    -------
+    Clus: list of membership
+    ClusDict: CommunityMembership, communities to members
+    number_split: number of communities that were split
+    """
+    Communities = CommunityMembership.from_membership(Clus)
+    oversized = [c for c, size in zip(Communities.keys(), Communities.sizes) if size > max_community_size]
+    if not oversized:
+        return Clus, Communities, 0
+
+    new_Clus = np.asarray(Clus).astype(str).astype(object)
+    stack = [(str(c), Communities[c]) for c in reversed(oversized)]
+    number_split = 0
+    while stack:
+        c, members = stack.pop()
+        number_split += 1
+        k = int(np.ceil(members.size / max_community_size))
+        Z = linkage(correlation_distance(values[members], dtype), method='ward')
+        sub = fcluster(Z, k, criterion='maxclust')
+        if len(set(sub)) == 1:
+            # no structure, e.g. identical rows; split by position
+            sub = np.arange(members.size) // max_community_size
+        children = []
+        for ii, (s, positions) in enumerate(CommunityMembership.from_membership(sub).items()):
+            child = '%s_%d' %(c, ii + 1)
+            new_Clus[members[positions]] = child
+            if positions.size > max_community_size:
+                children.append((child, members[positions]))
+        stack += reversed(children)
+
+    new_Clus = new_Clus.tolist()
+    return new_Clus, CommunityMembership.from_membership(new_Clus), number_split
+
+
+def community_pair_cost(sizes):
+    """
+    Relative PLS cost of a society's communities against any partner community:
+    sum of squared sizes of communities of 3 or more features.
+    """
+    sizes = np.asarray(sizes)
+    return int((sizes[sizes > 2]**2).sum())
+
+
+def rt_window_graph(values, retention_time, rt_window=None, min_weight=0.5, block_size=512):
+    """
+    Sparse graph of LC-MS features, with edges only between features within rt_window.
+    Edge weight is (1 - delta_RT/range_retention_time)*PearsonR, 
+    i.e. one minus the distance in hierachical_clustering_lcms, and only weights >= min_weight are kept.
+
+    Features are sorted by retention time, so that the neighbours of a block of rows 
+    are a contiguous slice; correlations are computed by one matrix product per block.
+    Memory is bounded by block_size x number of features in the window.
+
+    Parameters
+    ----------
+    values: data matrix as array, features as rows
+    retention_time: array of retention time per row
+    rt_window: in retention time units; default 5% of the retention time range
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of shape (number_features, number_features), upper triangle in original order
+    """
+    retention_time = np.asarray(retention_time, dtype=np.float64)
+    range_retention_time = retention_time.max() - retention_time.min()
+    if rt_window is None:
+        rt_window = 0.05 * range_retention_time
+    order = np.argsort(retention_time, kind='stable')
+    rt_sorted = retention_time[order]
+    Z = np.array(values, dtype=np.float64)[order]
+    Z -= Z.mean(axis=1, keepdims=True)
+    norm = np.sqrt((Z**2).sum(axis=1, keepdims=True))
+    norm[norm == 0] = 1
+    Z /= norm
+
+    n = Z.shape[0]
+    rows, cols, weights = [], [], []
+    for i0 in range(0, n, block_size):
+        i1 = min(n, i0 + block_size)
+        hi = np.searchsorted(rt_sorted, rt_sorted[i1 - 1] + rt_window, side='right')
+        delta_RT = rt_sorted[i0:hi][None, :] - rt_sorted[i0:i1][:, None]
+        W = (1 - delta_RT / range_retention_time) * (Z[i0:i1] @ Z[i0:hi].T)
+        # upper triangle within window, sorted positions
+        keep = (delta_RT <= rt_window) & (W >= min_weight) \
+               & (np.arange(i0, hi)[None, :] > np.arange(i0, i1)[:, None])
+        ii, jj = np.nonzero(keep)
+        rows.append(order[ii + i0])
+        cols.append(order[jj + i0])
+        weights.append(W[ii, jj])
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return sparse.csr_matrix((np.concatenate(weights), (np.minimum(rows, cols), np.maximum(rows, cols))), 
+                             shape=(n, n))
+
+
+def lcms_rt_window_communities(DataMatrix, FeatureAnnotation, rt_window=None, min_weight=0.5, 
+                               resolution=1.0, seed=0):
+    """Scalable clustering of LC-MS data by considering retention time.
+    A sparse graph is built within a sliding retention time window (rt_window_graph),
+    then partitioned by the Leiden algorithm (leidenalg.RBConfigurationVertexPartition).
+    Features without edges are singleton communities.
+
+    Metabolomics FeatureAnnotation must have column 'rtime'.
+
+    Returns
+    -------
+    Clus: list of membership
+    ClusDict: CommunityMembership, communities to members
+    """
+    retention_time = FeatureAnnotation.loc[DataMatrix.index, 'rtime'].values
+    A = rt_window_graph(DataMatrix.values, retention_time, rt_window, min_weight).tocoo()
+    print("RT window graph: %d features, %d edges" %(A.shape[0], A.nnz))
+
+    G = igraph.Graph(n=A.shape[0], edges=list(zip(A.row.tolist(), A.col.tolist())))
+    G.es['weight'] = A.data.tolist()
+    Clus = leiden_partition(G, resolution, seed)
+
+    number_features, number_clusters = len(Clus), len(set(list(Clus)))
+    print("number of features: ", number_features)
+    print("number of communities: ", number_clusters)
+
+    # Compile clusters
+    ClusDict = CommunityMembership.from_membership(Clus)
+
+    return Clus, ClusDict
+
+
+def exact_knn(values, n_neighbors=15, block_size=1024):
+    """
+    Exact k nearest neighbours by Euclidean distance, each row counted as its own first neighbour.
+    Squared distances are computed by blocks of rows with matrix products,
+    and the nearest are selected by argpartition.
+
+    Returns
+    -------
+    indices, distances: arrays of shape (number_rows, n_neighbors), sorted by distance
+    """
+    X = np.asarray(values, dtype=np.float64)
+    n = X.shape[0]
+    n_neighbors = min(n_neighbors, n)
+    squared_norms = (X**2).sum(axis=1)
+    indices = np.empty((n, n_neighbors), dtype=np.int64)
+    distances = np.empty((n, n_neighbors))
+    for i0 in range(0, n, block_size):
+        i1 = min(n, i0 + block_size)
+        D = squared_norms[i0:i1, None] + squared_norms[None, :] - 2 * X[i0:i1] @ X.T
+        D[np.arange(i1 - i0), np.arange(i0, i1)] = -1         # self first
+        nearest = np.argpartition(D, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        d = np.take_along_axis(D, nearest, axis=1)
+        order = np.argsort(d, axis=1)
+        indices[i0:i1] = np.take_along_axis(nearest, order, axis=1)
+        distances[i0:i1] = np.sqrt(np.maximum(np.take_along_axis(d, order, axis=1), 0))
+    return indices, distances
+
+
+def fuzzy_knn_connectivities(indices, distances, n_iter=64):
+    """
+    Weighted symmetric kNN graph as UMAP fuzzy simplicial set, which is what scanpy.pp.neighbors uses.
+    For each row, rho is the distance to the nearest other neighbour, and sigma is found by 
+    bisection so that sum(exp(-(d - rho)/sigma)) = log2(n_neighbors); 
+    directed weights are combined by fuzzy union, w + w' - w * w'.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of connectivities
+    """
+    n, k = indices.shape
+    d = distances[:, 1:]
+    rho = d[:, 0]
+    target = np.log2(k)
+    lo, hi = np.zeros(n), np.full(n, np.inf)
+    sigma = np.ones(n)
+    for ii in range(n_iter):
+        total = np.exp(-np.maximum(d - rho[:, None], 0) / sigma[:, None]).sum(axis=1)
+        larger = total > target
+        hi = np.where(larger, sigma, hi)
+        lo = np.where(larger, lo, sigma)
+        sigma = np.where(np.isinf(hi), sigma * 2, (lo + hi) / 2)
+    weights = np.exp(-np.maximum(d - rho[:, None], 0) / sigma[:, None])
+    W = sparse.csr_matrix((weights.ravel(), (np.repeat(np.arange(n), k - 1), indices[:, 1:].ravel())), 
+                          shape=(n, n))
+    return W + W.T - W.multiply(W.T)
+
+
+def _random_projection_leaves(X, leaf_size, rng):
+    """
+    Leaves of one random projection tree, as list of index arrays.
+    Each node is split by the hyperplane halfway between two of its points, picked at random.
+    """
+    leaves, stack = [], [np.arange(X.shape[0])]
+    while stack:
+        node = stack.pop()
+        if node.size <= leaf_size:
+            leaves.append(node)
+            continue
+        a, b = X[rng.choice(node, 2, replace=False)]
+        side = (X[node] - (a + b) / 2) @ (a - b) > 0
+        if side.all() or not side.any():                      # duplicated points
+            side = rng.random(node.size) < 0.5
+        stack += [node[side], node[~side]]
+    return leaves
+
+
+def _merge_neighbors(indices, distances, rows, candidates, candidate_distances):
+    """
+    Merge candidates into current neighbours of rows, in place; duplicates and self are dropped.
+    """
+    all_i = np.hstack((indices[rows], candidates))
+    all_d = np.hstack((distances[rows], candidate_distances))
+    order = np.argsort(all_i, axis=1, kind='stable')
+    sorted_i = np.take_along_axis(all_i, order, axis=1)
+    dropped = np.zeros(all_i.shape, dtype=bool)
+    dropped[:, 1:] = sorted_i[:, 1:] == sorted_i[:, :-1]
+    dropped |= sorted_i == rows[:, None]
+    np.put_along_axis(all_d, order, np.where(dropped, np.inf, np.take_along_axis(all_d, order, axis=1)), axis=1)
+    k = indices.shape[1]
+    nearest = np.argpartition(all_d, k - 1, axis=1)[:, :k]
+    indices[rows] = np.take_along_axis(all_i, nearest, axis=1)
+    distances[rows] = np.take_along_axis(all_d, nearest, axis=1)
+
+
+def approximate_knn(values, n_neighbors=15, n_trees=8, leaf_size=None, n_refine=1, seed=0, block_size=1024):
+    """
+    Approximate k nearest neighbours by a random projection forest, using only NumPy.
+    Points sharing a leaf in any of n_trees trees are candidate neighbours;
+    then n_refine rounds of neighbours-of-neighbours search improve the candidates.
+    More trees, larger leaves and more refinement rounds give higher recall at more compute.
+    Same output format as exact_knn, each row counted as its own first neighbour.
+
+    Parameters
+    ----------
+    values: data matrix, rows are points
+    n_neighbors: k, including self
+    n_trees, leaf_size, n_refine: recall/speed trade-off. leaf_size defaults to 4*n_neighbors.
+
+    Returns
+    -------
+    indices, distances: arrays of shape (number_rows, n_neighbors), sorted by distance
+    """
+    X = np.asarray(values, dtype=np.float64)
+    n = X.shape[0]
+    n_neighbors = min(n_neighbors, n)
+    k = n_neighbors - 1
+    if k == 0:
+        return exact_knn(X, n_neighbors)
+    leaf_size = max(leaf_size or 4 * n_neighbors, n_neighbors)
+    squared_norms = (X**2).sum(axis=1)
+    rng = np.random.default_rng(seed)
+    indices = np.tile(np.arange(n), (k, 1)).T
+    distances = np.full((n, k), np.inf)
+
+    for tree in range(n_trees):
+        for leaf in _random_projection_leaves(X, leaf_size, rng):
+            D = squared_norms[leaf, None] + squared_norms[None, leaf] - 2 * X[leaf] @ X[leaf].T
+            candidates = np.broadcast_to(leaf, D.shape)
+            _merge_neighbors(indices, distances, leaf, candidates, np.sqrt(np.maximum(D, 0)))
+
+    # rows left with fewer than k candidates, from small leaves
+    unfilled = np.flatnonzero(np.isinf(distances).any(axis=1))
+    for i0 in range(0, unfilled.size, block_size):
+        rows = unfilled[i0: i0 + block_size]
+        D = squared_norms[rows, None] + squared_norms[None, :] - 2 * X[rows] @ X.T
+        D[np.arange(rows.size), rows] = np.inf
+        nearest = np.argpartition(D, k - 1, axis=1)[:, :k]
+        indices[rows] = nearest
+        distances[rows] = np.sqrt(np.maximum(np.take_along_axis(D, nearest, axis=1), 0))
+
+    for r in range(n_refine):
+        neighbors = indices.copy()
+        for i0 in range(0, n, block_size // k + 1):
+            rows = np.arange(i0, min(n, i0 + block_size // k + 1))
+            candidates = neighbors[neighbors[rows]].reshape(rows.size, k * k)
+            D = squared_norms[rows, None] + squared_norms[candidates] \
+                - 2 * np.einsum('ij,ikj->ik', X[rows], X[candidates])
+            _merge_neighbors(indices, distances, rows, candidates, np.sqrt(np.maximum(D, 0)))
+
+    order = np.argsort(distances, axis=1)
+    indices = np.hstack((np.arange(n)[:, None], np.take_along_axis(indices, order, axis=1)))
+    distances = np.hstack((np.zeros((n, 1)), np.take_along_axis(distances, order, axis=1)))
+    return indices, distances
+
+
+def knn_recall(values, indices, sample_size=1000, seed=0):
+    """
+    Recall of approximate kNN indices against exact kNN, on a random sample of rows.
+    Self is excluded from both.
+    """
+    X = np.asarray(values, dtype=np.float64)
+    n, n_neighbors = indices.shape
+    rows = np.random.default_rng(seed).choice(n, min(sample_size, n), replace=False)
+    D = (X[rows]**2).sum(axis=1)[:, None] + (X**2).sum(axis=1)[None, :] - 2 * X[rows] @ X.T
+    D[np.arange(rows.size), rows] = np.inf
+    k = n_neighbors - 1
+    exact = np.argpartition(D, k - 1, axis=1)[:, :k]
+    found = sum(np.intersect1d(exact[ii], indices[r, 1:]).size for ii, r in enumerate(rows))
+    return found / (rows.size * k)
+
+
+def knn_graph(values, n_neighbors=15, knn_method='exact', n_trees=8, n_refine=1, seed=0):
+    """
+    igraph Graph of fuzzy kNN connectivities, with edge attribute 'weight'.
+    knn_method 'exact' or 'approximate' (random projection forest; recall is printed on a sample).
+    """
+    if knn_method == 'exact':
+        indices, distances = exact_knn(values, n_neighbors)
+    elif knn_method == 'approximate':
+        indices, distances = approximate_knn(values, n_neighbors, n_trees=n_trees, n_refine=n_refine, seed=seed)
+        print("approximate kNN recall on sample: %.3f" %knn_recall(values, indices, seed=seed))
+    else:
+        raise ValueError("Provide a valid knn_method, 'exact' or 'approximate'.")
+    A = sparse.triu(fuzzy_knn_connectivities(indices, distances), k=1).tocoo()
+    G = igraph.Graph(n=A.shape[0], edges=list(zip(A.row.tolist(), A.col.tolist())))
+    G.es['weight'] = A.data.tolist()
+    return G
+
+
+def leiden_partition(G, resolution=1.0, seed=0, n_iterations=-1):
+    """
+    Leiden partition of a weighted graph, as leidenalg.RBConfigurationVertexPartition.
+    n_iterations=-1 iterates until no improvement, as scanpy.tl.leiden does; 
+    leidenalg's own default of 2 is faster but less optimised.
+    Returns list of membership.
+    """
+    partition = leidenalg.find_partition(G, leidenalg.RBConfigurationVertexPartition, weights='weight', 
+                                         resolution_parameter=resolution, seed=seed, n_iterations=n_iterations)
+    return partition.membership
+
+
+def leiden_find_communities(df, method='modularity', n_neighbors=15, resolution=1.0, seed=0, backend='native',
+                            knn_method='exact', n_trees=8, n_refine=1, n_iterations=-1):
     """
     
     https://github.com/vtraag/leidenalg
     This finds the optimal partition using the Leiden algorithm [1], 
     which is an extension of the Louvain algorithm [2] for a number of different methods. 
-    leidenalg.find_partition(G, leidenalg.ModularityVertexPartition);
+    leidenalg.find_partition(G, leidenalg.RBConfigurationVertexPartition);
+
+    The native backend builds the kNN graph of features directly (exact_knn, fuzzy_knn_connectivities), 
+    as scanpy.pp.neighbors does. 
+    For large feature sets, knn_method='approximate' uses a random projection forest (approximate_knn),
+    with recall/speed tuned by n_trees and n_refine.
+    The scanpy backend is optional, and scanpy/anndata are only imported when it is used.
         
     Parameters
     ----------
     df: input dataframe (data matrix)
     method: default measure modularity
+    n_neighbors, resolution, seed: kNN graph size, Leiden resolution and random seed
+    backend: 'native' or 'scanpy'
+    knn_method, n_trees, n_refine: kNN graph construction for the native backend, 'exact' or 'approximate'
+    n_iterations: Leiden iterations for the native backend, -1 until no improvement (see leiden_partition)
 
     Returns
     -------
     Clus: list of membership
-    ClusDict: dictionary of communities to members
+    ClusDict: CommunityMembership, communities to members
     """
     #
-    scdm = anndata.AnnData(df)
-    sc.pp.neighbors(scdm, use_rep='X')
-    sc.tl.leiden(scdm)
-    Clus = list(scdm.obs['leiden'].values)
+    if backend == 'scanpy':
+        import scanpy as sc
+        import anndata
+        scdm = anndata.AnnData(df)
+        sc.pp.neighbors(scdm, n_neighbors=n_neighbors, use_rep='X')
+        sc.tl.leiden(scdm, resolution=resolution, random_state=seed)
+        Clus = list(scdm.obs['leiden'].values)
+    elif backend == 'native':
+        G = knn_graph(df.values, n_neighbors, knn_method, n_trees=n_trees, n_refine=n_refine, seed=seed)
+        Clus = leiden_partition(G, resolution, seed, n_iterations)
+    else:
+        raise ValueError("Provide a valid backend, 'native' or 'scanpy'.")
     #
     # using old code below. To be optimized
     #
@@ -177,18 +682,63 @@ def leiden_find_communities(df, method='modularity'):
     print("number of communities: ", number_clusters)
 
     # Compile clusters
-    ClusDict = {}
-    for ii in range(number_features):
-        # if ClusDict.has_key(Clus[ii]):
-        if Clus[ii] in ClusDict:
-            ClusDict[ Clus[ii] ].append(ii)
-        else:
-            ClusDict[ Clus[ii] ] = [ii]
+    ClusDict = CommunityMembership.from_membership(Clus)
 
     #print(ClusDict.items()[:3])    # This organizes cluster, members
     return Clus, ClusDict
 
 
+def _leiden_sweep_job(G, resolution, seed):
+    """
+    Leiden partition at one resolution, with modularity and community sizes.
+    """
+    Clus = leiden_partition(G, resolution, seed)
+    sizes = np.bincount(Clus)
+    return {'resolution': resolution,
+            'membership': Clus,
+            'modularity': G.modularity(Clus, weights='weight'),
+            'number_communities': sizes.size,
+            'community_sizes': {'min': int(sizes.min()), 'median': float(np.median(sizes)), 'max': int(sizes.max())},
+            }
+
+
+def leiden_resolution_sweep(df, resolutions, n_neighbors=15, seed=0, knn_method='exact', n_trees=8, n_refine=1,
+                            n_jobs=None, executor='process'):
+    """
+    Leiden communities at a list of resolutions, building the kNN graph once.
+    Resolutions are run in parallel on a pool of processes (the graph is pickled once per task).
+    leidenalg holds the GIL, so executor='thread' runs resolutions one at a time; 
+    it only saves pickling the graph, e.g. for small graphs.
+        
+    Parameters
+    ----------
+    df: input dataframe (data matrix)
+    resolutions: list of Leiden resolution parameters
+    n_neighbors, seed, knn_method, n_trees, n_refine: as in leiden_find_communities
+    n_jobs: number of workers, default os.cpu_count()
+    executor: 'process' or 'thread'
+
+    Returns
+    -------
+    list of dictionaries, in the order of resolutions,
+    {'resolution', 'membership', 'modularity', 'number_communities', 'community_sizes': {'min', 'median', 'max'}}
+    """
+    if executor == 'process':
+        Executor = ProcessPoolExecutor
+    elif executor == 'thread':
+        Executor = ThreadPoolExecutor
+    else:
+        raise ValueError("Provide a valid executor, 'process' or 'thread'.")
+    G = knn_graph(df.values, n_neighbors, knn_method, n_trees=n_trees, n_refine=n_refine, seed=seed)
+    with Executor(max_workers=min(n_jobs or os.cpu_count(), len(resolutions))) as pool:
+        futures = [pool.submit(_leiden_sweep_job, G, r, seed) for r in resolutions]
+        sweep = [f.result() for f in futures]
+    for result in sweep:
+        print("resolution %s: %d communities, modularity %.4f" %(
+            result['resolution'], result['number_communities'], result['modularity']))
+    return sweep
+
+
     
 def louvain_find_communities(df, method='modularity'):
     pass
\ No newline at end of file
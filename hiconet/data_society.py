@@ -16,16 +16,67 @@ Hieracrchical Community Network
     Treatment:
 
 """
+import os
+import tempfile
+import numpy as np
 import pandas as pd
-try:
-    from pandas.compat import StringIO
-except ImportError:
-    from io import StringIO
 
-from .input_functions import read_input_tables, fuzzy_index_2L, data_wrangler, \
+from .input_functions import read_input_tables, read_table, fuzzy_index_2L, data_wrangler, \
                             common_observation_IDs, common_subject_IDs, common_timepoint_labels, common_treatment_labels, \
                             auto_BTM_conversion, gene_2_btm
-from .community_detection import hierachical_clustering, leiden_find_communities, hierachical_clustering_lcms
+from .community_detection import hierachical_clustering, leiden_find_communities, hierachical_clustering_lcms, \
+                            lcms_rt_window_communities, leiden_resolution_sweep, CommunityMembership, \
+                            split_large_communities, community_pair_cost
+from .cache import array_digest, key_digest, get_cache_subdir, save_arrays, load_arrays, save_array, load_array
+
+
+class CommunityStore:
+    """
+    On-disk cache of community detection results, one .npz file per key in cache_dir/communities.
+    The key is made of content digests of DataMatrix values and index, the method and its parameters;
+    LC-MS methods also use retention time from FeatureAnnotation.
+    Communities are stored as Clus and the arrays of CommunityMembership, community_ids, 
+    and members of community_ids[i] as community_indices[community_indptr[i]: community_indptr[i+1]].
+    """
+    # part of the key, increased when default results of a method change (2: leiden to convergence)
+    version = 2
+
+    def __init__(self, cache_dir):
+        self.cache_dir = get_cache_subdir(cache_dir, 'communities')
+        self.hits, self.misses = 0, 0
+
+    def key(self, DataMatrix, method, parameters, FeatureAnnotation=None):
+        key = [self.version, array_digest(np.asarray(DataMatrix.values, dtype=np.float64)), 
+               array_digest(np.asarray(DataMatrix.index.astype(str), dtype=str)),
+               method, tuple(sorted((k, repr(v)) for k, v in parameters.items()))]
+        if method.startswith('lcms'):
+            key.append(array_digest(np.asarray(FeatureAnnotation.loc[DataMatrix.index, 'rtime'], dtype=np.float64)))
+        return tuple(key)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key_digest(*key) + '.npz')
+
+    def get(self, key):
+        """
+        Return (Clus, Communities), or None.
+        """
+        arrays = load_arrays(self._path(key))
+        if arrays is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays['Clus'], CommunityMembership(arrays['community_ids'], arrays['community_indptr'], 
+                                                   arrays['community_indices'])
+
+    def put(self, key, Clus, Communities):
+        Communities = CommunityMembership.from_dict(Communities)
+        save_arrays(self._path(key), 
+                    Clus=np.asarray(Clus),
+                    community_ids=Communities.labels,
+                    community_indptr=Communities.indptr,
+                    community_indices=Communities.indices,
+                    )
+
 
 class Society:
     """
@@ -40,7 +91,7 @@ class Society:
     Time points or treatments are used in slicing data for further analysis - Think those as sample groups.
 
     """
-    def __init__(self, dict_society, _dir):
+    def __init__(self, dict_society, _dir, cache_dir=None, tables=None):
         """
         Initiation from files.
         Given the size of these files, the web version will aslo take files and store first.
@@ -54,25 +105,41 @@ class Society:
         'file_observation_annotation': '',
         'file_unstructured': '', }
         
-        self.Communities is a dictionary {community_ID: [feature_ID, ...], ...}
+        self.Communities is a CommunityMembership, used as dictionary {community_ID: [feature_ID, ...], ...}
         self.Clus is [feature_community_number, ...]
 
+        If cache_dir is given, parsed input tables (TableStore) and community detection results (CommunityStore) 
+        are kept on disk, and not recomputed for the same files, DataMatrix, method and parameters.
+        tables, if given, are the pre-read output of read_input_tables, so that files are not read again.
+        Optional 'dtype' (e.g. float32) and 'memmap' in dict_society select compact storage of DataMatrix,
+        see compact_DataMatrix.
+
         """
         self.name = dict_society['name']
         self.datatype = dict_society['datatype']
         self.graph = []
-        self.Communities = {}
+        self.Communities = CommunityMembership.from_dict({})
         self.track_messages = []
+        self.cache_dir = cache_dir
+        self.community_cache = CommunityStore(cache_dir) if cache_dir else None
+        self.memmap, self.memmap_path = False, None
         
         # these are overall subjects and time points, not necessarily in data matrix
         self.subjects = []
         self.timepoints = []
         
-        self.populate_data_tables(dict_society, _dir)
-        self.get_communities()
+        self.populate_data_tables(dict_society, _dir, tables)
+        # optional compact storage, e.g. 'dtype: float32' and 'memmap: True'
+        if dict_society.get('dtype') or dict_society.get('memmap'):
+            self.compact_DataMatrix(dict_society.get('dtype', 'float32'), dict_society.get('memmap', False))
+        self.memory_message_index = len(self.track_messages)
+        self.track_messages.append(self.memory_report())
+        # optional method and parameters of community detection, e.g. 'community_detection: lcms_rt_window'
+        self.get_communities(dict_society.get('community_detection', ''), 
+                             **(dict_society.get('community_parameters') or {}))
 
 
-    def populate_data_tables(self, dict_society, _dir):
+    def populate_data_tables(self, dict_society, _dir, tables=None):
         """
         Get input tables, also match annotation, check stats
         #[DataMatrix, ObservationAnnotation, FeatureAnnotation, unstructured,] = read_input_tables(_Data_Directory, dict_society)
@@ -84,7 +151,7 @@ class Society:
         self.ObservationAnnotation,
         self.FeatureAnnotation,
         self.unstructured,
-        ] = read_input_tables(_dir, dict_society)
+        ] = tables or read_input_tables(_dir, dict_society, self.cache_dir)
 
         # clean up DataMatrix
         self.cleanup()
@@ -209,20 +276,89 @@ class Society:
             print(message)
 
 
-    def get_communities(self, method=''):
+    def compact_DataMatrix(self, dtype='float32', memmap=False):
+        """
+        Keep DataMatrix values in dtype, and drop raw_DataMatrix after cleanup.
+        If memmap, values are in a memory-mapped .npy file, 
+        in cache_dir/matrices if cache_dir is given, otherwise in an anonymous temporary file.
+        PLS is still computed in float64 on the sliced community blocks.
+        """
+        values = np.asarray(self.DataMatrix.values, dtype=dtype)
+        self.memmap, self.memmap_path = memmap, None
+        if memmap and self.cache_dir:
+            path = os.path.join(get_cache_subdir(self.cache_dir, 'matrices'), 
+                                key_digest(self.name, array_digest(values)) + '.npy')
+            if not os.path.exists(path):
+                save_array(path, values)
+            values = load_array(path)
+            self.memmap_path = path
+        elif memmap:
+            mapped = np.memmap(tempfile.TemporaryFile(), dtype=values.dtype, mode='w+', shape=values.shape)
+            mapped[:] = values
+            values = mapped
+        self.DataMatrix = pd.DataFrame(values, index=self.DataMatrix.index, columns=self.DataMatrix.columns, 
+                                       copy=False)
+        self.raw_DataMatrix = None
+
+    def __getstate__(self):
+        # a DataMatrix memory-mapped from cache_dir is pickled (e.g. back from a worker process) as its file path
+        state = self.__dict__.copy()
+        if state.get('memmap_path'):
+            state['DataMatrix'] = (self.DataMatrix.index, self.DataMatrix.columns)
+        return state
+
+    def __setstate__(self, state):
+        # memory mapping does not survive pickling; DataMatrix is mapped again and memory_report updated
+        self.__dict__.update(state)
+        if not getattr(self, 'memmap', False):
+            return
+        if self.memmap_path:
+            index, columns = self.DataMatrix
+            self.DataMatrix = pd.DataFrame(load_array(self.memmap_path), index=index, columns=columns, copy=False)
+        else:
+            self.compact_DataMatrix(self.DataMatrix.values.dtype, memmap=True)
+        self.track_messages[self.memory_message_index] = self.memory_report()
+
+    def memory_report(self):
+        """
+        Memory of data tables in MB, as a message; memory-mapped DataMatrix values are marked,
+        as they are paged from file rather than held in memory.
+        """
+        def size(table):
+            if isinstance(table, pd.DataFrame):
+                return table.memory_usage(index=True, deep=True).sum() / 2**20
+            return 0
+
+        values, mapped = self.DataMatrix.values, False
+        base = values
+        while base is not None and not mapped:
+            mapped, base = isinstance(base, np.memmap), getattr(base, 'base', None)
+        message = "Memory of %s (MB): DataMatrix %.2f (%s%s), raw_DataMatrix %.2f, " \
+                  "FeatureAnnotation %.2f, ObservationAnnotation %.2f." %(
+                  self.name, size(self.DataMatrix), values.dtype, ', memory-mapped' if mapped else '', 
+                  size(self.raw_DataMatrix), size(self.FeatureAnnotation), size(self.ObservationAnnotation))
+        print(message)
+        return message
+
+    def get_communities(self, method='', max_community_size=None, **parameters):
         """
         Default is leiden method for commuity detection.
         If not specified, lcms_hcl is default for LC-MS metabolomics.
+        lcms_rt_window is a scalable alternative to lcms_hcl for large LC-MS feature tables.
+        parameters are passed to the method, e.g. distanceCut for hcl, rt_window for lcms_rt_window.
+        If max_community_size is given, larger communities are split into sub-communities 
+        with hierarchical IDs (see split_large_communities), and the cost reduction is added to track_messages.
         
         option to designate minimal cluster number/size, and optimal number of clusters.
 
-        self.Communities is a dictionary {community_ID: [feature_ID, ...], ...}
+        self.Communities is a CommunityMembership, used as dictionary {community_ID: [feature_ID, ...], ...}
         
         TO-DO add community annotation function
         
         """
         available_methods = ['hcl',
                             'lcms_hcl',
+                            'lcms_rt_window',
                             #'spec-Girvan-Newman',
                             #'Louvain',
                             'leiden',
@@ -232,31 +368,94 @@ class Society:
             if self.datatype == 'metabolomics': method = 'lcms_hcl'     # this needs further specifications for more data formats
             else: method = 'leiden'
         
+        if self.community_cache and method in available_methods:
+            key = self.community_cache.key(self.DataMatrix, method, 
+                        dict(parameters, max_community_size=max_community_size) if max_community_size else parameters, 
+                        self.FeatureAnnotation)
+            cached = self.community_cache.get(key)
+            if cached is not None:
+                self.Clus, self.Communities = cached
+                self.track_messages.append("Communities ({}) read from cache.".format(method))
+                return
+
         # dispatch 
         if method == 'leiden':
-            self.Clus, self.Communities = leiden_find_communities(self.DataMatrix)
+            self.Clus, self.Communities = leiden_find_communities(self.DataMatrix, **parameters)
         elif method == 'lcms_hcl':
             # also using information, e.g. retention time, in FeatureAnnotation
             print("Using lcms_hcl for LC-MS metabolomics.")
-            self.Clus, self.Communities = hierachical_clustering_lcms(self.DataMatrix, self.FeatureAnnotation)
+            self.Clus, self.Communities = hierachical_clustering_lcms(self.DataMatrix, self.FeatureAnnotation, 
+                                                                      **parameters)
+        elif method == 'lcms_rt_window':
+            print("Using lcms_rt_window for LC-MS metabolomics.")
+            self.Clus, self.Communities = lcms_rt_window_communities(self.DataMatrix, self.FeatureAnnotation, 
+                                                                     **parameters)
         elif method == 'hcl':
             # is this a good return format?
-            self.Clus, self.Communities = hierachical_clustering(self.DataMatrix)
+            self.Clus, self.Communities = hierachical_clustering(self.DataMatrix, **parameters)
         elif method not in available_methods:
             raise ValueError('Provide a valid method, one of {}.'.format(available_methods))
 
+        if max_community_size:
+            self.split_communities(max_community_size)
+        if self.community_cache:
+            self.community_cache.put(key, self.Clus, self.Communities)
         #self.annotate_communities()
 
 
+    def split_communities(self, max_community_size):
+        """
+        Split communities larger than max_community_size, and report the reduction of PLS cost,
+        i.e. sum of squared community sizes, which PLS per community pair and per permutation scales with.
+        """
+        sizes_before = CommunityMembership.from_dict(self.Communities).sizes
+        self.Clus, self.Communities, number_split = split_large_communities(
+                                        self.DataMatrix.values, self.Clus, max_community_size)
+        if number_split:
+            cost_before, cost_after = community_pair_cost(sizes_before), community_pair_cost(self.Communities.sizes)
+            message = "Split %d communities over %d features: largest community %d -> %d, " \
+                      "%d -> %d communities, PLS cost per partner community %d -> %d (%.1f fold)." %(
+                      number_split, max_community_size, sizes_before.max(), self.Communities.sizes.max(),
+                      sizes_before.size, len(self.Communities), cost_before, cost_after, 
+                      cost_before / max(cost_after, 1))
+            print(message)
+            self.track_messages.append(message)
+
+    def sweep_leiden_resolutions(self, resolutions, **parameters):
+        """
+        Run leiden at a list of resolutions on one kNN graph, see leiden_resolution_sweep.
+        parameters, e.g. n_neighbors, n_jobs, executor (default 'process'), are passed to leiden_resolution_sweep.
+        Results are kept in self.resolution_sweep, and returned as list of 
+        {'resolution', 'membership', 'modularity', 'number_communities', 'community_sizes'}.
+        Use set_leiden_resolution to choose one without recomputing.
+        """
+        self.resolution_sweep = leiden_resolution_sweep(self.DataMatrix, resolutions, **parameters)
+        return self.resolution_sweep
+
+    def set_leiden_resolution(self, resolution):
+        """
+        Set self.Clus and self.Communities from the partition at resolution in self.resolution_sweep,
+        so that they are used by pairNetwork.
+        """
+        for result in self.resolution_sweep:
+            if result['resolution'] == resolution:
+                self.Clus = result['membership']
+                self.Communities = CommunityMembership.from_membership(self.Clus)
+                self.track_messages.append("Using leiden communities at resolution %s." %resolution)
+                return
+        raise ValueError('Resolution {} not in sweep.'.format(resolution))
+
+
     def export_communities_table(self):
         """
         TO-DO: improve community annotation
         """
+        Communities = CommunityMembership.from_dict(self.Communities)
+        names = np.asarray(self.feature_member_annotation, dtype=object)[Communities.indices]
         s = "community_number\tfeature_number\tfeature_name\n"
-        for k,v in self.Communities.items():
-            for member in v:
-                s += '\t'.join([str(x) for x in 
-                                [k, member, self.feature_member_annotation[member]]]) + '\n'
+        labels = np.repeat(Communities.labels, Communities.sizes).tolist()
+        s += ''.join(['\t'.join([str(x) for x in L]) + '\n' 
+                      for L in zip(labels, Communities.indices.tolist(), names)])
         return s
 
 
@@ -266,7 +465,7 @@ class webSociety(Society):
     self.get_communities() is run upon init.
     """
     
-    def populate_data_tables(self, dict_society, _dir=''):
+    def populate_data_tables(self, dict_society, _dir='', tables=None):
         """
         Get input tables, also match annotation, check stats
         #[DataMatrix, ObservationAnnotation, FeatureAnnotation, unstructured,] = read_input_tables(_Data_Directory, dict_society)
@@ -275,13 +474,13 @@ class webSociety(Society):
             'datatype': 'transcriptomics', 
             'file_data_matrix': input_str,
             }
+        Table content is str, or bytes that may be compressed by gzip, bz2 or xz.
         All tables have to comply with format: data matrix is M x N, features as col 0.
         Annotation tables use col 0 as common ID
         
         For web input, pre-matched data columns are required, thus simplified data matching.
         """
-        self.raw_DataMatrix = pd.read_csv(
-            StringIO(dict_society['file_data_matrix']), sep='\t', index_col=0)
+        self.raw_DataMatrix = read_table(self.as_bytes(dict_society['file_data_matrix']), index_col=0)
         # pre-matched data columns are required for web I/O
         # ObservationAnnotation has to be constructed in a way to be compatible with default data structure 
         self.ObservationAnnotation = {}
@@ -289,8 +488,7 @@ class webSociety(Society):
         
         self.FeatureAnnotation = {}
         if dict_society['file_feature_annotation']:
-            self.FeatureAnnotation = pd.read_csv(
-                StringIO(dict_society['file_feature_annotation']), sep='\t', index_col=0)
+            self.FeatureAnnotation = read_table(self.as_bytes(dict_society['file_feature_annotation']), index_col=0)
 
         
         # clean up DataMatrix
@@ -303,6 +501,11 @@ class webSociety(Society):
         # subj _ time point _ treatment group
         self.get_observation_annotation()
         
+    @staticmethod
+    def as_bytes(content):
+        # web input is table content, not a file path
+        return content.encode() if isinstance(content, str) else content
+
     def get_observation_annotation(self):
         """
         simplified for web I/O, which requires prematched samples.
@@ -18,6 +18,27 @@ societies:
   file_feature_annotation: ''
   file_observation_annotation: ''
   file_unstructured: ''
+  dtype: float32              # optional compact DataMatrix, raw_DataMatrix dropped after cleanup
+  memmap: True                # optional, DataMatrix values in a memory-mapped file
+
+- name: fcs
+  datatype: facs
+  file_long_table: 'SDY372_fcs_analyzed_result.txt'    # long format, one value per row, see read_long_table
+  long_table_columns: {subject: SUBJECT_ACCESSION, timepoint: STUDY_TIME_COLLECTED, 
+                       feature: POPULATION_NAME_REPORTED, value: POPULATION_CELL_NUMBER}
+
+# optional computing options
+n_jobs: 4                   # number of worker processes
+society_jobs: 2             # workers to read and build societies, default n_jobs
+seed: 1                     # random seed for permutations; if not given with cache_dir, a seed is kept in cache_dir
+num_permutation: 200
+p_value_method: empirical   # or polyfit
+adaptive_permutation: True  # sequential permutation per community pair, up to max_permutation;
+                            # tests each pair against the null of its own community sizes,
+                            # not the null pooled over all size pairs as with fixed num_permutation
+max_permutation: 10000
+null_mode: resample         # or label, permuting subject labels between societies
+cache_dir: 'hiconet_cache'  # relative to workdir; keeps parsed tables, permutation scores and communities across runs
 
 # use load, not load_all
 >>> j = yaml.load_all(open('project.yaml').read())
@@ -35,8 +56,12 @@ societies:
 workdir is also passed to proj_dict after reading yaml.
 """
 import os, yaml
+import io
+import gzip, bz2, lzma
+import hashlib
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from fuzzywuzzy import process as fuzzyfind
 
 try:
@@ -45,6 +70,7 @@ except ImportError:
     from yaml import Loader, Dumper
 
 from .btm.btm_example_data import ModuleIndex, ModuleDict
+from .cache import key_digest, get_cache_subdir, save_array, load_array, write_atomic
 
 # Will need better management of parameters
 #_Data_Directory = './datasets/SDY80/'
@@ -60,7 +86,90 @@ common_timepoint_labels = ['STUDY_TIME_COLLECTED', 'Study Time Collected', 'time
 common_treatment_labels = ['treatment', 'infected']
 
 
-def read_input_tables(_dir, dict_society):
+# magic bytes of compressed formats, and their stream openers
+compression_magic = [(b'\x1f\x8b', gzip.open), 
+                     (b'BZh', bz2.open), 
+                     (b'\xfd7zXZ\x00', lzma.open),
+                     ]
+
+def open_input(source):
+    """
+    Open a table as a binary stream, from a local file path (str), or uploaded content (bytes).
+    gzip, bz2 and xz compression is detected by magic bytes and decompressed while parsing,
+    without temporary files.
+    """
+    if isinstance(source, bytes):
+        head, source = source[:6], io.BytesIO(source)
+    else:
+        with open(source, 'rb') as F:
+            head = F.read(6)
+    for magic, opener in compression_magic:
+        if head.startswith(magic):
+            return opener(source, 'rb')
+    return source if isinstance(source, io.BytesIO) else open(source, 'rb')
+
+
+def read_table(source, index_col=None):
+    """
+    pd.read_csv of a tab-delimited table from a file path or uploaded bytes, compressed or not.
+    """
+    with open_input(source) as F:
+        return pd.read_csv(F, sep='\t', index_col=index_col)
+
+
+class TableStore:
+    """
+    Parse cache of tab-delimited input tables, in cache_dir/tables.
+
+    A file is looked up by path, size and mtime; if these changed, by content hash,
+    so that a touched or copied file is not parsed again.
+    Tables of one numeric dtype, e.g. data matrices, keep their values as .npy, memory-mapped when read, 
+    with index and columns in a pickle sidecar; other tables are kept as one pickle.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = get_cache_subdir(cache_dir, 'tables')
+
+    @staticmethod
+    def content_digest(path, chunk_size=2**24):
+        h = hashlib.sha1()
+        with open(path, 'rb') as F:
+            for chunk in iter(lambda: F.read(chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def read(self, path, index_col=None):
+        """
+        Return DataFrame as read_table(path, index_col), from cache if available.
+        """
+        st = os.stat(path)
+        stat_file = os.path.join(self.cache_dir, 
+                        key_digest(os.path.abspath(path), st.st_size, st.st_mtime_ns, index_col) + '.key')
+        if os.path.exists(stat_file):
+            with open(stat_file) as F:
+                content = F.read()
+        else:
+            content = self.content_digest(path)
+            write_atomic(stat_file, lambda O: O.write(content), mode='w')
+        base = os.path.join(self.cache_dir, key_digest(content, index_col))
+
+        if os.path.exists(base + '.pkl'):
+            sidecar = pd.read_pickle(base + '.pkl')
+            if 'table' in sidecar:
+                return sidecar['table']
+            return pd.DataFrame(load_array(base + '.npy'), index=sidecar['index'], columns=sidecar['columns'], 
+                                copy=False)
+
+        df = read_table(path, index_col)
+        if df.shape[1] and df.dtypes.nunique() == 1 and df.dtypes.iloc[0].kind in 'fiu':
+            save_array(base + '.npy', df.to_numpy())
+            sidecar = {'index': df.index, 'columns': df.columns}
+        else:
+            sidecar = {'table': df}
+        write_atomic(base + '.pkl', lambda O: pd.to_pickle(sidecar, O))
+        return df
+
+
+def read_input_tables(_dir, dict_society, cache_dir=None):
     """Process input files into dataframes/dict for HiCoNet
 
     Parameters
@@ -76,24 +185,38 @@ def read_input_tables(_dir, dict_society):
     Annotation tables use col 0 as common ID
     unstructured is optional.
 
+    Instead of file_data_matrix and file_observation_annotation, a society can give a long-format file,
+        'file_long_table': 'SDY372_fcs_results.txt',
+        'long_table_columns': {'subject': ..., 'timepoint': ..., 'feature': ..., 'value': ...},
+    see read_long_table.
+    Files may be compressed by gzip, bz2 or xz (see open_input).
+    If cache_dir is given, parsed tables are kept in a TableStore and not parsed again in later runs.
+
     Returns
     -------
     unprocessed, unlinked tables:
     [DataMatrix, ObservationAnnotation, FeatureAnnotation, unstructured]
     """
-    DataMatrix = pd.read_csv(
-        os.path.join(_dir, dict_society['file_data_matrix']), sep='\t', index_col=0)  # index_col=0 specifies format for the feature column.
+    read = TableStore(cache_dir).read if cache_dir else read_table
+
+    if dict_society.get('file_long_table'):
+        # long-format results are pivoted into DataMatrix and ObservationAnnotation
+        DataMatrix, ObservationAnnotation = read_long_table(
+            os.path.join(_dir, dict_society['file_long_table']), dict_society['long_table_columns'])
+    else:
+        DataMatrix = read(
+            os.path.join(_dir, dict_society['file_data_matrix']), index_col=0)  # index_col=0 specifies format for the feature column.
                                                         # pandas can use 1st col as feature index if the 1st row misses 1st cell, 
                                                         # but the R convention should be avoided here for more general applications
-    ObservationAnnotation = pd.read_csv(
-        os.path.join(_dir, dict_society['file_observation_annotation']), sep='\t')    # not using index_col=0
+        ObservationAnnotation = read(
+            os.path.join(_dir, dict_society['file_observation_annotation']))    # not using index_col=0
 
     FeatureAnnotation = {}
-    if dict_society['file_feature_annotation']:
-        FeatureAnnotation = pd.read_csv(os.path.join(_dir, dict_society['file_feature_annotation']), sep='\t', index_col=0)
+    if dict_society.get('file_feature_annotation'):
+        FeatureAnnotation = read(os.path.join(_dir, dict_society['file_feature_annotation']), index_col=0)
 
     unstructured = {}
-    if dict_society['file_unstructured']:
+    if dict_society.get('file_unstructured'):
         unstructured = {}
 
     return [DataMatrix, ObservationAnnotation, FeatureAnnotation, unstructured]
@@ -142,9 +265,10 @@ def get_project_dict(_source='local', _dir='.'):
             # web test
             newlist = []
             for sc in d['societies']:
-                sc['file_data_matrix'] = open(os.path.join(_dir, sc['file_data_matrix'])).read()
+                # as bytes, which may be compressed, see open_input
+                sc['file_data_matrix'] = open(os.path.join(_dir, sc['file_data_matrix']), 'rb').read()
                 if sc['file_feature_annotation']:
-                    sc['file_feature_annotation'] = open(os.path.join(_dir, sc['file_feature_annotation'] )).read()
+                    sc['file_feature_annotation'] = open(os.path.join(_dir, sc['file_feature_annotation'] ), 'rb').read()
                 newlist.append(sc)
             d['societies'] = newlist
             return d
@@ -243,58 +367,70 @@ def fuzzy_index_2L(targetList, L):
         return [None, None]
 
 
-def data_indexer(df):
-    """Data indexing by subject and timepoint.
-    Will remove all quotes.
-    
-    Not used now.
+def _global_codes(labels, index):
+    """
+    Integer codes of labels in index {label: code}, adding new labels in order of appearance.
+    Returns codes, and positions of the first rows of new labels.
+    """
+    local, uniques = pd.factorize(labels)
+    start = len(index)
+    for u in uniques:
+        index.setdefault(u, len(index))
+    mapping = np.array([index[u] for u in uniques], dtype=np.int64)
+    first_rows = np.unique(local, return_index=True)[1]
+    return mapping[local], first_rows[mapping >= start]
 
-    In [34]: bigdict = {}
-    
-    In [35]: for line in w[1:]:
-        ...:     # construct index subj_timepoint_cellpopulation
-        ...:     a = line.split('\t')
-        ...:     k = a[1].replace('"', '').replace('.372', '') + '_' + a[6] + '_' + a[11].replace('"', '')
-        ...:     bigdict[k] = a[8]
-        ...:     
-    
-    In [36]: bigdict.items()[:4]
-    Out[36]: 
-    [('SUB135758_90_CD8+ T cell', '"510.6118469238281"'),
-     ('SUB135773_28_Tfh17 CD4+ T cell', '"21.569305419921875"'),
-     ('SUB135772_28_CD40- BDCA3+ myeloid dendritic cell', '"0.37419480085372925"'),
-     ('SUB135772_0_HLA-DR+ Th1 CD4+ T cell', '"0.06463897228240967"')]
-    
-    In [37]: # construct wanted list
-    
-    In [38]: s = 'CellPopulation\t' + '\t'.join(populations) + '\n'
-    
-    In [39]: row = [x+"_0_" for x in subjects] + [x+"_1_" for x in subjects] + [x+"_7_" for x in subjects] + [x+"_28_" for
-        ...:  x in subjects] + [x+"_90_" for x in subjects]
-    
-    In [40]: len(row)
-    Out[40]: 85
-    
-    In [41]: row[:4]
-    Out[41]: ['SUB135758_0_', 'SUB135759_0_', 'SUB135760_0_', 'SUB135761_0_']
-    
-    In [42]: s = 'CellPopulation\t' + '\t'.join(row) + '\n'
-    
-    In [43]: for p in populations:
-        ...:     s += p + '\t' + '\t'.join([bigdict.get(x+p, 'NA') for x in row]) + '\n'
-        ...:     
-    
-    In [44]: with open('formatted_SDY372_fcs_analyzed_result.txt', 'w') as O:
-        ...:     O.write(s)
-        ...:     
-    
-    In [45]: # quotes included in the output above
-    
 
+def read_long_table(path, columns, chunksize=10**6):
+    """
+    Pivot a long-format result table, one value per row (e.g. ImmPort FCS or titer results: 
+    subject, time point, population, value), into DataMatrix (features x observations) 
+    and the matching ObservationAnnotation.
+    This replaces the manual workflow of building a dictionary of all values then writing a wide table.
 
+    The file (compressed or not, see open_input) is read in chunks of rows and 
+    values are written into a growing matrix, so that memory is bounded by one chunk and the result.
+    Observation IDs are subject_timepoint, in order of first appearance; 
+    features are in order of first appearance; repeated entries keep the last value.
+
+    Parameters
+    ----------
+    path: tab-delimited long-format file
+    columns: {'subject': column name, 'timepoint': column name, 'feature': column name, 'value': column name}
+    chunksize: number of rows per chunk
+
+    Returns
+    -------
+    DataMatrix, ObservationAnnotation with columns observation_ID, SUBJECT_ACCESSION, STUDY_TIME_COLLECTED
     """
-    value_dict = {}
-    return value_dict
+    subject, timepoint, feature, value = [columns[x] for x in ['subject', 'timepoint', 'feature', 'value']]
+    features, observations = {}, {}
+    subjects, timepoints = [], []
+    M = np.full((64, 64), np.nan)
+    with open_input(path) as F:
+        for chunk in pd.read_csv(F, sep='\t', usecols=[subject, timepoint, feature, value], dtype=str, 
+                                 chunksize=chunksize):
+            chunk = chunk.dropna(subset=[subject, timepoint, feature])
+            f_codes = _global_codes(chunk[feature].values, features)[0]
+            o_codes, new_rows = _global_codes((chunk[subject] + '_' + chunk[timepoint]).values, observations)
+            subjects += chunk[subject].values[new_rows].tolist()
+            timepoints += chunk[timepoint].values[new_rows].tolist()
+            if len(features) > M.shape[0] or len(observations) > M.shape[1]:
+                grown = np.full((max(len(features), 2 * M.shape[0]), max(len(observations), 2 * M.shape[1])), np.nan)
+                grown[:M.shape[0], :M.shape[1]] = M
+                M = grown
+            M[f_codes, o_codes] = pd.to_numeric(chunk[value], errors='coerce').values
+
+    DataMatrix = pd.DataFrame(M[:len(features), :len(observations)], 
+                              index=list(features.keys()), columns=list(observations.keys()))
+    try:
+        timepoints = pd.to_numeric(pd.Series(timepoints))
+    except ValueError:
+        pass
+    ObservationAnnotation = pd.DataFrame({'observation_ID': list(observations.keys()), 
+                                          'SUBJECT_ACCESSION': subjects, 
+                                          'STUDY_TIME_COLLECTED': timepoints})
+    return DataMatrix, ObservationAnnotation
 
 
 def compute_activity_score(M, df_gene):
@@ -313,14 +449,54 @@ def compute_activity_score(M, df_gene):
     N = len(data)
     return np.array(data).sum(0)/N
 
+# (module code, member gene) pairs of all modules in ModuleIndex, built once
+_btm_member_modules = np.repeat(np.arange(len(ModuleIndex)), [len(ModuleDict[x]) for x in ModuleIndex])
+_btm_member_genes = pd.Series([g for x in ModuleIndex for g in ModuleDict[x]])
+
+def btm_membership_matrix(genes):
+    """
+    Sparse module x gene membership matrix of ModuleIndex, aligned to genes (e.g. index of gene table).
+    Entry [i, j] is the number of times genes[j] is listed in module ModuleIndex[i];
+    a gene repeated in genes is matched at its first position.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of shape (len(ModuleIndex), len(genes))
+    """
+    position = {g: j for j, g in reversed(list(enumerate(genes)))}
+    cols = _btm_member_genes.map(position).values
+    found = ~np.isnan(cols)
+    return sparse.csr_matrix((np.ones(found.sum()), (_btm_member_modules[found], cols[found].astype(np.int64))), 
+                             shape=(len(ModuleIndex), len(genes)))
+
 def gene_2_btm(df_gene):
-    """Convert gene dataframe to BTM dataframe
+    """Convert gene dataframe to BTM dataframe.
+    Activity scores are mean expression values of member genes, as compute_activity_score, 
+    computed for all modules as one sparse matrix product.
+    Modules without member genes in df_gene are dropped.
     """
-    data = []
-    cols = df_gene.columns
-    for x in ModuleIndex:
-        data.append( compute_activity_score(ModuleDict[x], df_gene) )
-    df = pd.DataFrame(np.array(data), index=ModuleIndex, columns=cols)
-    
-    return df
+    return genes_2_btm([df_gene])[0]
 
+def genes_2_btm(tables):
+    """Convert a list of gene dataframes to BTM dataframes.
+    Tables on the same gene index share one membership matrix, and their columns are scored in one product.
+    """
+    groups = {}
+    for i, df in enumerate(tables):
+        groups.setdefault(tuple(df.index), []).append(i)
+
+    results = [None] * len(tables)
+    for genes, members in groups.items():
+        M = btm_membership_matrix(genes)
+        counts = np.asarray(M.sum(1)).ravel()
+        keep = counts > 0
+        values = np.hstack([tables[i].values.astype(np.float64) for i in members])
+        scores = (M[keep] @ values) / counts[keep][:, None]
+        modules = np.array(ModuleIndex, dtype=object)[keep]
+        start = 0
+        for i in members:
+            cols = tables[i].columns
+            results[i] = pd.DataFrame(scores[:, start: start+len(cols)], index=modules, columns=cols)
+            start += len(cols)
+
+    return results
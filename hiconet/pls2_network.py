@@ -6,11 +6,412 @@ This module contains the function to build
 PLS2 association networks 
 """
 
-from random import sample as permutation
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from sklearn.cross_decomposition import PLSRegression
 
 from .input_functions import NUM_PERMUTATION
+from .cache import array_digest, key_digest, get_cache_subdir, save_array, load_array, write_atomic
+from .shared_data import share_arrays, attach_arrays, release_blocks
+from .community_detection import CommunityMembership
+
+# Permutation rounds are drawn in blocks, each block from its own seeded stream.
+# Results thus do not depend on how blocks are distributed to worker processes.
+PERMUTATION_BLOCK = 10
+
+
+def standardize_blocks(A):
+    """
+    Center and scale each column of stacked blocks, as PLSRegression(scale=True) does.
+
+    Parameters
+    ----------
+    A: array of shape (number_blocks, number_samples, number_features)
+
+    Returns
+    -------
+    new array of same shape; constant columns become zero.
+    """
+    A = np.asarray(A, dtype=np.float64)
+    constant = A.max(axis=1, keepdims=True) == A.min(axis=1, keepdims=True)
+    mean = A.mean(axis=1, keepdims=True)
+    std = A.std(axis=1, ddof=1, keepdims=True)
+    std[std == 0] = 1.0
+    # constant columns are exactly zero, not rounding residues of the mean
+    return np.where(constant, 0.0, (A - mean) / std)
+
+
+def pls2_scores_from_covariance(Cxy, Gxx, ss_y, n_components=3):
+    """
+    Batched PLS2 regression from covariance blocks of standardized data, returning R^2 scores.
+    With Xs and Ys the standardized predictors and responses of a block pair, 
+    Cxy = Xs'Ys, Gxx = Xs'Xs, and ss_y = diagonal of Ys'Ys.
+    Deflation is done on Cxy and Gxx directly, 
+    as X_{k+1}'Y_{k+1} = Cxy_k - t't * p c' and X_{k+1}'X_{k+1} = Gxx_k - t't * p p',
+    so that the data matrices are not needed after the covariance blocks are computed.
+    Each component's weights are the dominant singular vector of the deflated Cxy, 
+    which the NIPALS inner loop in sklearn converges to.
+
+    Parameters
+    ----------
+    Cxy: array of shape (number_blocks, p, q)
+    Gxx: array of shape (number_blocks, p, p)
+    ss_y: array of shape (number_blocks, q), (number_samples - 1) or 0 for constant columns
+
+    Returns
+    -------
+    array of R^2 scores, shape (number_blocks,)
+    """
+    number_blocks, p, q = Cxy.shape
+    W = np.zeros((number_blocks, p, n_components))
+    P = np.zeros((number_blocks, p, n_components))
+    C = np.zeros((number_blocks, q, n_components))
+    Ck, Gk = Cxy.copy(), Gxx.copy()
+    for k in range(n_components):
+        u, s, vt = np.linalg.svd(Ck, full_matrices=False)
+        w = u[:, :, :1]                                 # x_weights, (B, p, 1)
+        Gw = Gk @ w
+        tt = np.swapaxes(w, 1, 2) @ Gw                  # x_scores squared norm, (B, 1, 1)
+        tt[tt == 0] = 1.0                               # fully deflated block
+        x_loadings = Gw / tt                            # (B, p, 1)
+        y_loadings = np.swapaxes(Ck, 1, 2) @ w / tt     # (B, q, 1)
+        # deflation in regression mode
+        Ck -= tt * x_loadings @ np.swapaxes(y_loadings, 1, 2)
+        Gk -= tt * x_loadings @ np.swapaxes(x_loadings, 1, 2)
+        W[:, :, k], P[:, :, k], C[:, :, k] = w[:, :, 0], x_loadings[:, :, 0], y_loadings[:, :, 0]
+
+    # coefficients in standardized space; R^2 is scale invariant
+    rotations = W @ np.linalg.pinv(np.swapaxes(P, 1, 2) @ W)
+    coef = rotations @ np.swapaxes(C, 1, 2)             # (B, p, q)
+    # residual sum of squares per response column, ||Ys - Xs coef||^2
+    ss_res = ss_y - 2 * (coef * Cxy).sum(axis=1) + (coef * (Gxx @ coef)).sum(axis=1)
+    ss_res = np.maximum(ss_res, 0)
+    # constant columns have no variance to explain, and add 0 
+    # (sklearn r2_score would give 1.0, making spurious edges of constant communities)
+    r2 = np.where(ss_y > 0, 1 - ss_res / np.where(ss_y > 0, ss_y, 1), 0.0)
+    return r2.mean(axis=1)
+
+
+def pls2_scores(X, Y, n_components=3):
+    """
+    Batched PLS2 regression, returning the R^2 score of each block pair.
+    This reproduces PLSRegression(n_components).fit(X, Y).score(X, Y) from sklearn
+    for many small blocks of the same shape at once.
+
+    Parameters
+    ----------
+    X: array of shape (number_blocks, number_samples, p), predictors
+    Y: array of shape (number_blocks, number_samples, q), responses
+
+    Returns
+    -------
+    array of R^2 scores, shape (number_blocks,)
+    """
+    X, Y = standardize_blocks(X), standardize_blocks(Y)
+    Xt = np.swapaxes(X, 1, 2)
+    return pls2_scores_from_covariance(Xt @ Y, Xt @ X, (Y**2).sum(axis=1), n_components)
+
+
+def orient_blocks(matrix1, matrix2):
+    """
+    Legacy convention: the block with more features is used as predictors X.
+    Returns (X, Y) for stacked blocks of shape (number_blocks, number_samples, features).
+    """
+    if matrix1.shape[2] > matrix2.shape[2]:
+        return matrix1, matrix2
+    else:
+        return matrix2, matrix1
+
+
+def split_range(N, number_chunks):
+    """
+    Split range(N) into number_chunks contiguous [(start, stop), ...], skipping empty ones.
+    """
+    bounds = np.linspace(0, N, number_chunks + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def permutation_job(job, gArray, mArray):
+    """
+    Compute PLS2 scores for a range of permutation rounds of one community size pair.
+
+    Parameters
+    ----------
+    job: (seed, g, m, SampleNumber, first_round, last_round)
+    gArray, mArray: value pools to draw random blocks from
+
+    Returns
+    -------
+    array of scores for permutation rounds [first_round, last_round)
+    """
+    seed, g, m, SampleNumber, first_round, last_round = job
+    first_block, last_block = first_round // PERMUTATION_BLOCK, -(-last_round // PERMUTATION_BLOCK)
+    matrix1, matrix2 = [], []
+    for block in range(first_block, last_block):
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(g, m, block)))
+        # full blocks are always drawn, so that round k has the same values in any job
+        matrix1.append( gArray[rng.integers(0, gArray.size, (PERMUTATION_BLOCK, SampleNumber, g))] )
+        matrix2.append( mArray[rng.integers(0, mArray.size, (PERMUTATION_BLOCK, SampleNumber, m))] )
+    wanted = slice(first_round - first_block * PERMUTATION_BLOCK, last_round - first_block * PERMUTATION_BLOCK)
+    matrix1, matrix2 = np.concatenate(matrix1)[wanted], np.concatenate(matrix2)[wanted]
+    return pls2_scores(*orient_blocks(matrix1, matrix2))
+
+
+# value pools in worker processes, {digest: array}, attached to shared memory once by the pool initializer
+_worker_value_pools = {}
+_worker_value_blocks = []
+
+def _init_worker_value_pools(descriptor):
+    arrays, _worker_value_blocks[:] = attach_arrays(descriptor)
+    _worker_value_pools.clear()
+    _worker_value_pools.update(arrays)
+
+def _worker_permutation_job(job, pools):
+    return permutation_job(job, _worker_value_pools[pools[0]], _worker_value_pools[pools[1]])
+
+
+class CommunityCovariance:
+    """
+    Covariance blocks of all community pairs between two society slices.
+
+    Each slice is standardized once (features as rows, scaled as PLSRegression does on columns),
+    and community members are laid out contiguously, so that the cross-covariance of all members 
+    is one matrix product, gZ mZ'. A community pair then takes its block of the cross-covariance, 
+    the Gram matrix of its predictor community and the sums of squares of its response community.
+    Pairs of the same shape are scored in one batch by pls2_scores_from_covariance.
+
+    Gram matrices and sums of squares do not change when observations of mZ are permuted, 
+    thus a label permutation only needs a new cross-covariance.
+    """
+    def __init__(self, gCommunities, mCommunities, gDF, mDF):
+        gCommunities, mCommunities = CommunityMembership.from_dict(gCommunities), \
+                                     CommunityMembership.from_dict(mCommunities)
+        gUsed, mUsed = gCommunities.sizes >= 3, mCommunities.sizes >= 3
+        gLabels, mLabels = gCommunities.labels[gUsed].tolist(), mCommunities.labels[mUsed].tolist()
+        gSizes, mSizes = gCommunities.sizes[gUsed], mCommunities.sizes[mUsed]
+        self.pairs = [(g, m) for g in gLabels for m in mLabels]
+        if not self.pairs:
+            return
+
+        # {community_ID: slice of rows in gZ or mZ}
+        gStarts, mStarts = np.cumsum(gSizes) - gSizes, np.cumsum(mSizes) - mSizes
+        self.gSlices = dict((g, slice(a, a + n)) for g, a, n in zip(gLabels, gStarts.tolist(), gSizes.tolist()))
+        self.mSlices = dict((m, slice(a, a + n)) for m, a, n in zip(mLabels, mStarts.tolist(), mSizes.tolist()))
+
+        # members of used communities, contiguous in community order
+        self.gZ = self.standardize_rows(gDF.values[gCommunities.indices[np.repeat(gUsed, gCommunities.sizes)], :])
+        self.mZ = self.standardize_rows(mDF.values[mCommunities.indices[np.repeat(mUsed, mCommunities.sizes)], :])
+        self.cross_covariance = self.gZ @ self.mZ.T
+        self.gSS, self.mSS = (self.gZ**2).sum(axis=1), (self.mZ**2).sum(axis=1)
+        self.gGram = dict((g, self.gZ[sl] @ self.gZ[sl].T) for g, sl in self.gSlices.items())
+        self.mGram = dict((m, self.mZ[sl] @ self.mZ[sl].T) for m, sl in self.mSlices.items())
+
+        # group pairs by block shape, {(size_g, size_m): [pair_index, ...]}
+        self.shapes = {}
+        pair_shapes = zip(np.repeat(gSizes, len(mLabels)).tolist(), np.tile(mSizes, len(gLabels)).tolist())
+        for ii, shape in enumerate(pair_shapes):
+            self.shapes.setdefault(shape, []).append(ii)
+
+    @staticmethod
+    def standardize_rows(values):
+        values = np.asarray(values, dtype=np.float64)
+        constant = values.max(axis=1, keepdims=True) == values.min(axis=1, keepdims=True)
+        values = values - values.mean(axis=1, keepdims=True)
+        std = values.std(axis=1, ddof=1, keepdims=True)
+        std[std == 0] = 1.0
+        return np.where(constant, 0.0, values / std)
+
+    def scores(self, cross_covariances):
+        """
+        PLS2 scores of all community pairs, for a stack of cross-covariances 
+        of shape (number_rounds, rows of gZ, rows of mZ).
+        Returns array of shape (number_rounds, number_pairs).
+        """
+        number_rounds = cross_covariances.shape[0]
+        scores = np.zeros((number_rounds, len(self.pairs)))
+        for (size_g, size_m), indices in self.shapes.items():
+            gPairs, mPairs = [self.pairs[ii][0] for ii in indices], [self.pairs[ii][1] for ii in indices]
+            # (number_rounds * number_pairs, size_g, size_m)
+            Cxy = np.stack([cross_covariances[:, self.gSlices[g], self.mSlices[m]] 
+                            for g, m in zip(gPairs, mPairs)], axis=1).reshape(-1, size_g, size_m)
+            # legacy convention: the community with more features is used as predictors
+            if size_g > size_m:
+                Gxx, ss_y = np.stack([self.gGram[g] for g in gPairs]), np.stack([self.mSS[self.mSlices[m]] for m in mPairs])
+            else:
+                Cxy = np.swapaxes(Cxy, 1, 2)
+                Gxx, ss_y = np.stack([self.mGram[m] for m in mPairs]), np.stack([self.gSS[self.gSlices[g]] for g in gPairs])
+            Gxx = np.broadcast_to(Gxx, (number_rounds,) + Gxx.shape).reshape((-1,) + Gxx.shape[1:])
+            ss_y = np.broadcast_to(ss_y, (number_rounds,) + ss_y.shape).reshape((-1,) + ss_y.shape[1:])
+            scores[:, indices] = pls2_scores_from_covariance(Cxy, Gxx, ss_y).reshape(number_rounds, -1)
+        return scores
+
+    def label_permutation_scores(self, permutations, max_buffer_size=2**25):
+        """
+        PLS2 scores of all community pairs after permuting observations of mZ.
+        Rounds are processed in chunks, each as one batched matrix product
+        gZ (mZ[:, permutation])' into preallocated buffers of at most max_buffer_size values.
+
+        Parameters
+        ----------
+        permutations: integer array of shape (number_rounds, number_samples)
+
+        Returns
+        -------
+        array of shape (number_rounds, number_pairs)
+        """
+        number_rounds, number_samples = permutations.shape
+        size_g, size_m = self.gZ.shape[0], self.mZ.shape[0]
+        chunk = max(1, min(number_rounds, 
+                           max_buffer_size // max(size_g * size_m, size_m * number_samples)))
+        permuted = np.empty((chunk, size_m, number_samples))
+        cross_covariances = np.empty((chunk, size_g, size_m))
+        scores = np.zeros((number_rounds, len(self.pairs)))
+        for start in range(0, number_rounds, chunk):
+            n = min(chunk, number_rounds - start)
+            for ii in range(n):
+                np.take(self.mZ, permutations[start + ii], axis=1, out=permuted[ii])
+            np.matmul(self.gZ, np.swapaxes(permuted[:n], 1, 2), out=cross_covariances[:n])
+            scores[start: start + n] = self.scores(cross_covariances[:n])
+        return scores
+
+
+class NullDistributionCache:
+    """
+    Permutation scores shared by pairNetworks, as 
+    {(digest_pool1, digest_pool2, SampleNumber, seed, g, m): array of scores per permutation round, ...}.
+
+    The permutation null depends only on the value pools of two societies, 
+    the community sizes and SampleNumber. 
+    All timepoint pairs of two societies with the same sample number thus share scores.
+    Stored arrays may be shorter than requested; pairNetwork then computes the missing rounds only.
+    """
+    def __init__(self):
+        self.scores = {}
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        """
+        Return stored scores (any number of rounds), or None.
+        """
+        S = self.scores.get(key)
+        if S is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return S
+
+    def put(self, key, scores):
+        self.scores[key] = scores
+
+
+class NullDistributionStore(NullDistributionCache):
+    """
+    Persistent NullDistributionCache, saving each score array as a .npy file in cache_dir.
+    File name is a digest of the key, i.e. content digests of the value pools, 
+    SampleNumber, seed and the size pair. 
+    The number of permutation rounds is the length of the stored array, 
+    which grows when a later run asks for more permutations.
+    Arrays are memory-mapped when read.
+    As the seed is part of every key, default_seed keeps one seed in cache_dir for runs not given a seed.
+    """
+    def __init__(self, cache_dir):
+        NullDistributionCache.__init__(self)
+        self.cache_dir = get_cache_subdir(cache_dir, 'null_distributions')
+
+    def default_seed(self):
+        """
+        Seed saved in cache_dir, created from fresh entropy on first use, 
+        so that runs without a given seed reuse the stored permutation scores.
+        """
+        path = os.path.join(self.cache_dir, 'seed.txt')
+        if not os.path.exists(path):
+            write_atomic(path, lambda O: O.write(str(np.random.SeedSequence().entropy)), mode='w')
+        with open(path) as F:
+            return int(F.read())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key_digest(*key) + '.npy')
+
+    def get(self, key):
+        if key not in self.scores:
+            S = load_array(self._path(key))
+            if S is not None:
+                self.scores[key] = S
+        return NullDistributionCache.get(self, key)
+
+    def put(self, key, scores):
+        save_array(self._path(key), scores)
+        self.scores[key] = load_array(self._path(key))
+
+
+def size_pair_scores(wanted, pools, null_cache, n_jobs=1):
+    '''
+    Permutation scores of community size pairs, for any number of value pool pairs,
+    so that the nulls of several pairNetworks can be computed together.
+    Rounds already in null_cache are not recomputed; only additional rounds are.
+    Jobs of permutation rounds are run on a process pool if n_jobs > 1, 
+    with the value pools in shared memory.
+
+    Parameters
+    ----------
+    wanted: {(digest1, digest2, SampleNumber, seed, g, m): number of rounds, ...}, keys of null_cache
+    pools: {digest: value pool}, digest as array_digest of the pool
+    null_cache: NullDistributionCache or NullDistributionStore
+
+    Returns
+    -------
+    {key: array of scores of the wanted rounds, ...}
+    '''
+    # rounds to compute, {key: first_round}
+    scores, missing = {}, {}
+    for key, numPermutation in wanted.items():
+        stored = null_cache.get(key)
+        if stored is None:
+            scores[key], missing[key] = np.zeros(0), 0
+        else:
+            scores[key] = stored[:numPermutation]
+            if stored.size < numPermutation:
+                missing[key] = stored.size
+
+    # split rounds of each size pair only when there are too few pairs to keep workers busy
+    number_chunks = -(-4 * n_jobs // max(1, len(missing)))
+    jobs = []
+    for key, first_round in missing.items():
+        digest1, digest2, SampleNumber, seed, g, m = key
+        numPermutation = wanted[key]
+        number_blocks = -(-(numPermutation - first_round) // PERMUTATION_BLOCK)
+        for a, b in split_range(number_blocks, min(number_blocks, number_chunks)):
+            jobs.append(((seed, g, m, SampleNumber, 
+                          first_round + a * PERMUTATION_BLOCK, 
+                          min(numPermutation, first_round + b * PERMUTATION_BLOCK)), (digest1, digest2)))
+
+    print ("            Permutation --- up to %d rounds, %d community size pairs, %d to compute, %d jobs" 
+            %(max(wanted.values(), default=0), len(wanted), len(missing), len(jobs)))
+    if n_jobs > 1 and jobs:
+        # value pools are shared with workers, not copied into each
+        used = set(digest for job in jobs for digest in job[1])
+        descriptor, blocks = share_arrays(dict((digest, pools[digest]) for digest in used))
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker_value_pools, 
+                                     initargs=(descriptor,)) as executor:
+                results = list(executor.map(_worker_permutation_job, *zip(*jobs), 
+                                            chunksize=max(1, len(jobs) // (4 * n_jobs))))
+        finally:
+            release_blocks(blocks)
+    else:
+        results = [permutation_job(job, pools[digests[0]], pools[digests[1]]) for job, digests in jobs]
+
+    # results of the same key are appended in round order
+    collected = {}
+    for (job, digests), result in zip(jobs, results):
+        seed, g, m, SampleNumber = job[:4]
+        collected.setdefault(digests + (SampleNumber, seed, g, m), []).append(result)
+    for key in missing:
+        scores[key] = np.concatenate([scores[key]] + collected[key])
+        null_cache.put(key, scores[key])
+
+    return scores
 
 
 class pairNetwork:
@@ -27,17 +428,47 @@ class pairNetwork:
 
     Permutation is done here to compute p-values for association R.
     Resampling is done on the whole society.
+    Permutation rounds are spread over n_jobs processes. 
+    A given seed gives identical results regardless of n_jobs; 
+    if seed is None, fresh entropy is used and kept in self.seed.
+    Permutation scores are taken from null_cache (NullDistributionCache or NullDistributionStore) 
+    when available, which can be shared by all pairNetworks of a project or across runs.
+    p_value_method is 'polyfit' or 'empirical', see get_p_values.
+    If adaptive, each community pair is tested by sequential permutation against the null of its own 
+    community sizes, see get_p_values_adaptive; otherwise against the null pooled over all size pairs.
+    Number of permutation rounds per edge is kept in self.permutation_counts.
+
+    null_mode selects how the null distribution is made:
+    'resample', random values drawn from the whole societies (default);
+    'label', subject labels of society2 permuted against society1, 
+    keeping the correlation structure within communities; adaptive does not apply.
 
     """
-    def __init__(self, association_dict, society1, society2):
+    def __init__(self, association_dict, society1, society2, n_jobs=1, seed=None, null_cache=None, 
+                 numPermutation=NUM_PERMUTATION, p_value_method='polyfit', 
+                 adaptive=False, maxPermutation=10000, stopExceedances=10, null_mode='resample'):
         # 
+        if null_mode not in ('resample', 'label'):
+            raise ValueError("Provide a valid null_mode, 'resample' or 'label'.")
+        self.null_mode = null_mode
         self.dict = association_dict
+        self.p_value_method = p_value_method
+        self.adaptive = adaptive
+        self.maxPermutation = maxPermutation
+        self.stopExceedances = stopExceedances
+        self.n_jobs = n_jobs
+        self.numPermutation = numPermutation
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.null_cache = null_cache if null_cache is not None else NullDistributionCache()
         self.name = association_dict['name'] + '_' + str(association_dict['timepoint1']) + '_' + str(association_dict['timepoint2'])
         self.SampleNumber = len( association_dict['observation_list_society1'])
         
         # this runs PLS2 and get p-values via permutation test
         self.PLS_2datatypes(association_dict, society1, society2)
+        # not kept after computing, so that a pairNetwork stays small to pickle
+        self.covariance, self.null_cache = None, None
         # network_edges = [( g, m, PLSscore, p-value ), ...], g and m as community IDs from society1/2
+        # permutation_counts = {( g, m ): number of permutation rounds, ...}
         self.network_edges = self.pls_network_edges
      
 
@@ -48,63 +479,79 @@ class pairNetwork:
         '''
         label1, label2 = society1.name, society2.name
         # g and m here are legacy names, without specific meaning here
-        gCommunities, mCommunities = society1.Communities, society2.Communities
-        gSizes = [len(x) for x in gCommunities.values() if len(x) > 2]
-        mSizes = [len(x) for x in mCommunities.values() if len(x) > 2]
+        gCommunities, mCommunities = CommunityMembership.from_dict(society1.Communities), \
+                                     CommunityMembership.from_dict(society2.Communities)
+        gSizes = gCommunities.sizes[gCommunities.sizes > 2].tolist()
+        mSizes = mCommunities.sizes[mCommunities.sizes > 2].tolist()
         
-        gArray, mArray = list(society1.DataMatrix.values.flatten()), \
-                         list(society2.DataMatrix.values.flatten())
+        # value pools for permutation, as flat views rather than Python lists
+        gArray, mArray = society1.DataMatrix.values.ravel(), \
+                         society2.DataMatrix.values.ravel()
+        self.null_key = (array_digest(gArray), array_digest(mArray), self.SampleNumber, self.seed)
         gDF, mDF = society1.DataMatrix[association_dict['observation_list_society1']], \
                    society2.DataMatrix[association_dict['observation_list_society2']]
         
         # get PLS2 scores
         pls_scores = self.get_pls_scores_real(gCommunities, mCommunities, gDF, mDF)
-        # Do permutation
-        permutation_scores = self.get_pls_scores_permutation(gArray, mArray, gSizes, mSizes)
-        
-        #print("pls_scores", pls_scores)
-        #print("permutation_scores", permutation_scores)
-        
-        # Collect network edges [( node1, node2, PLSscore, p-value ), ...]
-        self.pls_network_edges = self.get_p_values(pls_scores, permutation_scores)
+        # Do permutation, and collect network edges [( node1, node2, PLSscore, p-value ), ...]
+        if self.null_mode == 'label':
+            permutation_scores = self.get_pls_scores_label_permutation(self.numPermutation)
+            self.pls_network_edges = self.get_p_values(pls_scores, permutation_scores, self.p_value_method)
+            self.permutation_counts = dict(((x[0], x[1]), self.numPermutation) for x in pls_scores)
+        elif self.adaptive:
+            self.pls_network_edges, self.permutation_counts = self.get_p_values_adaptive(
+                                        pls_scores, gArray, mArray, gCommunities, mCommunities)
+        else:
+            permutation_scores = self.get_pls_scores_permutation(gArray, mArray, gSizes, mSizes, 
+                                                                 self.numPermutation)
+            self.pls_network_edges = self.get_p_values(pls_scores, permutation_scores, self.p_value_method)
+            self.permutation_counts = dict(((x[0], x[1]), self.numPermutation) for x in pls_scores)
         
         
-    def get_p_values(self, pls_scores, permutation_scores):
+    def get_p_values(self, pls_scores, permutation_scores, method='polyfit'):
         '''
-        Compute p-value by polyfit the permutation_scores
+        Compute p-value from the permutation_scores, 
+        by polyfit (default) or as exact empirical p-value.
         
         Parameters
         ----------
         pls_scores, permutation_scores
+        method: 'polyfit', fitting log10(p-value) of the top half of permutation scores by a cubic polynomial;
+                'empirical', (1 + number of permutation scores >= PLSscore) / (1 + number of permutation scores),
+                by searchsorted on the sorted permutation scores.
         
         Returns
         -------
         p-value list, [( g, m, PLSscore, p-value ), ...], g and m as community IDs from society1/2
         '''
-        # polyfit permutation scores
-        # look up p-values for PLS scores via a fitted polynomial function. Rank based method is too slow. 
-        # More interested in the top 50%, and should down-sample in future version
-        plslistlength = len(permutation_scores)
-        # not limited to positive score here, to be more robust, i.e. tolerant to crapy data
-        permutation_scores_positive = permutation_scores    #[x for x in permutation_scores if x > 0]
-        N_positive = len(permutation_scores_positive)
-        N_to_use = int(N_positive/2)
-        permutation_scores_positive.sort(reverse=True)
-    
-        # fit a function log10(p-value) = f(score)
-        fp = np.polyfit( permutation_scores_positive[:N_to_use], 
-                         np.log10(np.arange(1,N_to_use+1)/float(plslistlength)), 
-                         3)
-    
-        def fp_predict(x, fp):
-            return fp[0]*x**3 + fp[1]*x**2 + fp[2]*x + fp[3]
-    
-        newlist = []
-        for x in pls_scores:
-            # ( g, m, PLSscore ), PLSscore is x[2]
+        null_scores = np.sort(np.asarray(permutation_scores, dtype=np.float64))
+        plslistlength = null_scores.size
+        real_scores = np.array([x[2] for x in pls_scores], dtype=np.float64)
+
+        if method == 'empirical':
+            # searchsorted left side counts null scores strictly below each PLSscore
+            number_exceeding = plslistlength - np.searchsorted(null_scores, real_scores, side='left')
+            p_values = (number_exceeding + 1) / float(plslistlength + 1)
+
+        elif method == 'polyfit':
+            # look up p-values for PLS scores via a fitted polynomial function.
+            # More interested in the top 50%, and should down-sample in future version
+            # not limited to positive score here, to be more robust, i.e. tolerant to crapy data
+            N_to_use = int(plslistlength/2)
+            permutation_scores_positive = null_scores[::-1]
+        
+            # fit a function log10(p-value) = f(score)
+            fp = np.polyfit( permutation_scores_positive[:N_to_use], 
+                             np.log10(np.arange(1,N_to_use+1)/float(plslistlength)), 
+                             3)
             # force p <= 1
-            newlist.append( (x[0], x[1], x[2], 
-                             min(1, 10**fp_predict(x[2], fp))) )
+            p_values = np.minimum(1, 10**np.polyval(fp, real_scores))
+
+        else:
+            raise ValueError("Provide a valid p-value method, 'polyfit' or 'empirical'.")
+    
+        # ( g, m, PLSscore ), PLSscore is x[2]
+        newlist = [(x[0], x[1], x[2], p) for x, p in zip(pls_scores, p_values.tolist())]
         # sort by PLSscore decending
         def sort2(val): return val[2]
         newlist.sort(key = sort2, reverse = True)
@@ -152,7 +599,8 @@ class pairNetwork:
 
     def get_pls_scores_real(self, gCommunities, mCommunities, gDF, mDF):
         '''
-        Compute PLS2 scores for all pairwise communities from two societies.
+        Compute PLS2 scores for all pairwise communities from two societies, 
+        via CommunityCovariance: one cross-covariance product, then per-pair blocks.
         
         Parameters
         ----------
@@ -163,30 +611,50 @@ class pairNetwork:
         -------
         pls_scores list as [( g, m, PLSscore ), ...]
         '''
-        PLS = PLSRegression(n_components=3)
-        pls_scores = []
-    
-        for g in gCommunities.keys():
-            if len(gCommunities[g]) >= 3:
-                #print(g,)
-                for m in mCommunities.keys():
-                    if len(mCommunities[m]) >= 3:
-                        # Getting corresponding rows from btm and metabo. 
-                        matrix1, matrix2 = gDF.values[ gCommunities[g], : ], mDF.values[ mCommunities[m], : ]
-                        matrix1, matrix2 = np.transpose(matrix1), np.transpose(matrix2)
-                        
-                        print("input matrices ", matrix1.shape, matrix2.shape)
-                        # PLS regression
-                        if matrix1.shape[1] > matrix2.shape[1]:
-                            PLS.fit(matrix1, matrix2)
-                            PLSscore = PLS.score(matrix1, matrix2) 
-                        else:
-                            PLS.fit(matrix2, matrix1)
-                            PLSscore = PLS.score(matrix2, matrix1)
-    
-                        pls_scores.append(( g, m, PLSscore ))
-    
-        return pls_scores
+        self.covariance = CommunityCovariance(gCommunities, mCommunities, gDF, mDF)
+        pairs = self.covariance.pairs
+        if not pairs:
+            return []
+        scores = self.covariance.scores(self.covariance.cross_covariance[None, :, :])[0]
+        print("PLS2 scores of %d community pairs, in %d block shapes" %(len(pairs), len(self.covariance.shapes)))
+        return [( g, m, PLSscore ) for (g, m), PLSscore in zip(pairs, scores.tolist())]
+
+
+    def get_pls_scores_label_permutation(self, numPermutation=NUM_PERMUTATION):
+        '''
+        Null distribution by permuting subject labels of society2 against society1,
+        which keeps the correlation structure within communities.
+        Uses self.covariance from get_pls_scores_real. 
+        Permutations come from a stream of self.seed, independent of n_jobs.
+
+        Returns
+        -------
+        array of permutation scores, all community pairs in all rounds
+        '''
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(0,)))
+        permutations = rng.permuted(np.tile(np.arange(self.SampleNumber), (numPermutation, 1)), axis=1)
+        print ("            Label permutation --- %d rounds, %d community pairs" 
+                %(numPermutation, len(self.covariance.pairs)))
+        return self.covariance.label_permutation_scores(permutations).ravel()
+
+
+    def get_size_pair_scores(self, gArray, mArray, wanted):
+        '''
+        Permutation scores of community size pairs, see size_pair_scores.
+
+        Parameters
+        ----------
+        gArray, mArray: value pools
+        wanted: {(g, m): number of rounds, ...}
+
+        Returns
+        -------
+        {(g, m): array of scores of the wanted rounds, ...}
+        '''
+        scores = size_pair_scores(dict((self.null_key + k, n) for k, n in wanted.items()), 
+                                  {self.null_key[0]: gArray, self.null_key[1]: mArray}, 
+                                  self.null_cache, self.n_jobs)
+        return dict((k[-2:], v) for k, v in scores.items())
 
 
     def get_pls_scores_permutation(self, gArray, mArray, gSizes, mSizes, 
@@ -194,36 +662,81 @@ class pairNetwork:
         '''
         g and m from legacy code, no particular meaning
         
+        For each pair of community sizes, numPermutation random blocks are drawn 
+        from the value pools gArray and mArray, and scored in batches.
+        Values are drawn with replacement, as the pools are far larger than SampleNumber.
+
+        Each distinct size pair is computed once, and its scores are weighted by 
+        the number of community pairs of that size. 
+        
         ???
         Permutation will be done within each data slice,
         due to different data characteristics in time points or delta, or etc.
         
         '''
-        SampleNumber = self.SampleNumber
-        PLS = PLSRegression(n_components=3)
-        scores = []
-        for jj in range(numPermutation):
-            if str(jj)[-1] == '0': print ("            Permutation --- %d" %jj)
-    
-            for g in gSizes:
-                matrix1 = []
-                for ii in range(g):
-                    matrix1.append(permutation(gArray, SampleNumber))
-                matrix1 = np.array(matrix1).T
-                for m in mSizes:
-                    matrix2 = []
-                    for ii in range(m):
-                        matrix2.append(permutation(mArray, SampleNumber))
-                    matrix2 = np.array(matrix2).T
-                    #
-                    if matrix1.shape[1] > matrix2.shape[1]:
-                        PLS.fit(matrix1, matrix2)
-                        PLSscore = PLS.score(matrix1, matrix2)
-                    else:
-                        PLS.fit(matrix2, matrix1)
-                        PLSscore = PLS.score(matrix2, matrix1)
-    
-                    scores.append( PLSscore )
-    
-        return scores
-    
+        gCounts, mCounts = Counter(gSizes), Counter(mSizes)
+        size_pairs = sorted([(g, m) for g in gCounts for m in mCounts])
+        pair_scores = self.get_size_pair_scores(gArray, mArray, dict.fromkeys(size_pairs, numPermutation))
+        scores = [np.tile(pair_scores[(g, m)], gCounts[g] * mCounts[m]) for g, m in size_pairs]
+        return np.concatenate(scores) if scores else np.zeros(0)
+
+
+    def get_p_values_adaptive(self, pls_scores, gArray, mArray, gCommunities, mCommunities):
+        '''
+        Sequential permutation test with early stopping (Besag and Clifford, 1991), per community pair.
+        Each pair is tested against the permutation scores of its own community sizes.
+
+        Rounds are drawn in batches, starting at self.numPermutation and doubling up to self.maxPermutation.
+        A pair stops at round L once h = self.stopExceedances permutation scores >= PLSscore are seen, 
+        with p-value h/L. Pairs reaching self.maxPermutation get p-value (1 + number exceeding)/(1 + maxPermutation).
+        Clearly non-significant pairs thus stop after a few dozen rounds, 
+        and only pairs near or below the significance threshold keep sampling.
+
+        Returns
+        -------
+        p-value list, [( g, m, PLSscore, p-value ), ...], sorted by PLSscore decending;
+        permutation counts, {(g, m): number of permutation rounds used, ...}
+        '''
+        h = self.stopExceedances
+        real_scores = np.array([x[2] for x in pls_scores], dtype=np.float64)
+        # pair indices grouped by size pair, {(g, m): array of pair indices}
+        gSizes, mSizes = dict(zip(gCommunities.keys(), gCommunities.sizes.tolist())), \
+                         dict(zip(mCommunities.keys(), mCommunities.sizes.tolist()))
+        groups = {}
+        for ii in range(len(pls_scores)):
+            g, m = pls_scores[ii][:2]
+            groups.setdefault((gSizes[g], mSizes[m]), []).append(ii)
+        groups = {k: np.array(v) for k, v in groups.items()}
+
+        exceeding = np.zeros(len(pls_scores), dtype=int)
+        counts = np.zeros(len(pls_scores), dtype=int)
+        p_values = np.ones(len(pls_scores))
+        active = np.ones(len(pls_scores), dtype=bool)
+        done, N = 0, min(self.numPermutation, self.maxPermutation)
+        while active.any():
+            wanted = {k: N for k, v in groups.items() if active[v].any()}
+            pair_scores = self.get_size_pair_scores(gArray, mArray, wanted)
+            for k in wanted:
+                pairs = groups[k][active[groups[k]]]
+                new_scores = np.asarray(pair_scores[k][done:N])
+                # cumulative exceedances over the new rounds, shape (pairs, rounds)
+                cumulative = exceeding[pairs, None] + np.cumsum(
+                                new_scores[None, :] >= real_scores[pairs, None], axis=1)
+                exceeding[pairs], counts[pairs] = cumulative[:, -1], N
+                stopped = cumulative[:, -1] >= h
+                L = done + 1 + np.argmax(cumulative[stopped] >= h, axis=1)
+                p_values[pairs[stopped]], counts[pairs[stopped]] = h / L, L
+                active[pairs[stopped]] = False
+
+            if N >= self.maxPermutation:
+                p_values[active] = (exceeding[active] + 1) / float(N + 1)
+                break
+            done, N = N, min(2 * N, self.maxPermutation)
+
+        print ("            Adaptive permutation --- %d pairs, %d rounds in total, %d pairs at maximum" 
+                %(len(pls_scores), counts.sum(), (counts == self.maxPermutation).sum()))
+        newlist = [(x[0], x[1], x[2], p) for x, p in zip(pls_scores, p_values.tolist())]
+        permutation_counts = dict(((x[0], x[1]), n) for x, n in zip(pls_scores, counts.tolist()))
+        def sort2(val): return val[2]
+        newlist.sort(key = sort2, reverse = True)
+        return newlist, permutation_counts
@@ -0,0 +1,132 @@
+"""Hieracrchical Community Network - shared memory for worker processes
+
+Arrays are placed in multiprocessing.shared_memory blocks by the parent process,
+and worker processes attach to them without copying.
+Only a small descriptor, {key: (block name, shape, dtype)}, crosses the process boundary.
+
+For a Society, the shared arrays are the float DataMatrix (in its own float dtype, e.g. float32), 
+the observation index (column labels),
+and community membership in the CSR layout of CommunityMembership:
+community_ids, and members of community_ids[i] as community_indices[community_indptr[i]: community_indptr[i+1]].
+"""
+
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from .community_detection import CommunityMembership
+
+
+def share_arrays(arrays):
+    """
+    Copy arrays into new shared memory blocks.
+
+    Parameters
+    ----------
+    arrays: {key: numpy array}, of numeric or fixed width string dtype
+
+    Returns
+    -------
+    descriptor {key: (block name, shape, dtype string)}, and list of SharedMemory blocks,
+    which the caller must keep and release by release_blocks.
+    """
+    descriptor, blocks = {}, []
+    for key, A in arrays.items():
+        A = np.ascontiguousarray(A)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, A.nbytes))
+        np.ndarray(A.shape, dtype=A.dtype, buffer=shm.buf)[...] = A
+        descriptor[key] = (shm.name, A.shape, A.dtype.str)
+        blocks.append(shm)
+    return descriptor, blocks
+
+
+def attach_arrays(descriptor):
+    """
+    Attach to shared memory blocks of a descriptor from share_arrays.
+    Returns {key: numpy array on shared memory}, and the SharedMemory blocks,
+    which must be kept as long as the arrays are used.
+    """
+    arrays, blocks = {}, []
+    for key, (name, shape, dtype) in descriptor.items():
+        shm = shared_memory.SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        blocks.append(shm)
+    return arrays, blocks
+
+
+def release_blocks(blocks, unlink=True):
+    """
+    Close shared memory blocks; the creating process also unlinks them.
+    """
+    for shm in blocks:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def _label_array(labels):
+    # shared memory takes numeric or fixed width string arrays, not Python objects
+    labels = np.asarray(list(labels))
+    if labels.dtype == object:
+        labels = labels.astype(str)
+    return labels
+
+
+def society_values(society):
+    """
+    DataMatrix values of a Society as shared with workers, in its own float dtype, or float64.
+    """
+    values = society.DataMatrix.values
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+    return values
+
+
+def share_society(society):
+    """
+    Place DataMatrix, observation index and Communities of a Society in shared memory.
+
+    Returns
+    -------
+    descriptor (with society name), and list of SharedMemory blocks to release after use.
+    """
+    Communities = CommunityMembership.from_dict(society.Communities)
+    values = society_values(society)
+    arrays = {
+        'DataMatrix': values,
+        'columns': _label_array(society.DataMatrix.columns),
+        'community_ids': _label_array(Communities.labels),
+        'community_indptr': Communities.indptr,
+        'community_indices': Communities.indices,
+        }
+    descriptor, blocks = share_arrays(arrays)
+    return {'name': society.name, 'arrays': descriptor}, blocks
+
+
+class sharedSocietyView:
+    """
+    Read-only view of a Society in a worker process, attached to shared memory.
+    Provides name, DataMatrix and Communities, as used by pairNetwork.
+    """
+    def __init__(self, descriptor):
+        self.name = descriptor['name']
+        arrays, self._blocks = attach_arrays(descriptor['arrays'])
+        self.DataMatrix = pd.DataFrame(arrays['DataMatrix'], columns=arrays['columns'], copy=False)
+        self.Communities = CommunityMembership(arrays['community_ids'], arrays['community_indptr'], 
+                                               arrays['community_indices'])
+
+    def close(self):
+        release_blocks(self._blocks, unlink=False)
+
+
+# views attached in a worker process, {first block name: sharedSocietyView}
+_attached_societies = {}
+
+def attach_society(descriptor):
+    """
+    Return a sharedSocietyView for descriptor, attaching once per process.
+    """
+    key = descriptor['arrays']['DataMatrix'][0]
+    if key not in _attached_societies:
+        _attached_societies[key] = sharedSocietyView(descriptor)
+    return _attached_societies[key]
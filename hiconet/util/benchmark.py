@@ -0,0 +1,150 @@
+"""benchmark.py
+
+Timing of the computing kernels in HiCoNet on synthetic data of realistic sizes.
+Not part of the analysis pipeline.
+
+Community sizes and sample numbers below are close to SDY80, 
+i.e. 3 to 50 features per community, 20 to 80 observations.
+
+python3 -m hiconet.util.benchmark
+"""
+
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import pdist
+
+from hiconet.pls2_network import pls2_scores, orient_blocks, pairNetwork
+from hiconet.community_detection import correlation_distance, hierachical_clustering
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for ii in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def peak_memory(func, *args):
+    """
+    Peak memory in MB of NumPy allocations during func(*args), by tracemalloc.
+    """
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+def make_blocks(number_blocks, number_samples, size1, size2, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(number_blocks, number_samples, size1)), \
+           rng.normal(size=(number_blocks, number_samples, size2))
+
+
+def bench_pls2(number_blocks=200, shapes=[(20, 3, 3), (40, 10, 5), (80, 50, 12)]):
+    """
+    Per-pair sklearn PLSRegression vs. batched pls2_scores, as in one permutation phase.
+    """
+    from sklearn.cross_decomposition import PLSRegression
+    
+    def sklearn_loop(X, Y):
+        PLS = PLSRegression(n_components=3)
+        return np.array([PLS.fit(X[ii], Y[ii]).score(X[ii], Y[ii]) for ii in range(X.shape[0])])
+
+    print("PLS2 scores, %d blocks per shape" %number_blocks)
+    print("samples\tsize1\tsize2\tsklearn_sec\tbatched_sec\tspeedup\tmax_abs_diff")
+    for (n, p, q) in shapes:
+        X, Y = orient_blocks(*make_blocks(number_blocks, n, p, q))
+        t_ref, ref = timeit(sklearn_loop, X, Y, repeat=1)
+        t_new, new = timeit(pls2_scores, X, Y)
+        print("%d\t%d\t%d\t%.4f\t%.4f\t%.1f\t%.2e" %(n, p, q, t_ref, t_new, t_ref/t_new, np.abs(ref - new).max()))
+
+
+
+def bench_correlation_distance(sizes=[2000, 5000, 10000], number_samples=40):
+    """
+    pdist 'correlation' vs. blocked correlation_distance in float64 and float32, 
+    time, pairs per second and peak memory, as input to hierachical_clustering.
+    """
+    print("Correlation distance, %d samples" %number_samples)
+    print("features\tmethod\tseconds\tMpairs_per_sec\tpeak_MB\tmax_abs_diff")
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        values = rng.normal(size=(n, number_samples))
+        number_pairs = n * (n - 1) / 2
+        t_ref, ref = timeit(pdist, values, 'correlation', repeat=1)
+        print("%d\tpdist\t%.3f\t%.1f\t%.1f\t0" %(n, t_ref, number_pairs/t_ref/1e6, 
+                                                 peak_memory(pdist, values, 'correlation')))
+        for dtype in [np.float64, np.float32]:
+            t, D = timeit(correlation_distance, values, dtype)
+            print("%d\tblocked_%s\t%.3f\t%.1f\t%.1f\t%.1e" %(n, np.dtype(dtype).name, t, number_pairs/t/1e6, 
+                                        peak_memory(correlation_distance, values, dtype), np.abs(ref - D).max()))
+
+
+def bench_hierachical_clustering(sizes=[2000, 6000], number_samples=40):
+    """
+    End-to-end hierachical_clustering (distance, linkage and tree cut) in float64 and float32,
+    time and peak memory. The distance kernel alone (bench_correlation_distance) hides that
+    linkage works on a float64 copy of a float32 distance vector.
+    """
+    print("Hierarchical clustering, %d samples" %number_samples)
+    print("features\tdtype\tseconds\tpeak_MB")
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        df = pd.DataFrame(rng.normal(size=(n, number_samples)))
+        for dtype in [np.float64, np.float32]:
+            t, _ = timeit(hierachical_clustering, df, 2, dtype, repeat=1)
+            print("%d\t%s\t%.3f\t%.1f" %(n, np.dtype(dtype).name, t, 
+                                         peak_memory(hierachical_clustering, df, 2, dtype)))
+
+
+
+class syntheticSociety:
+    """
+    Minimal stand-in of Society for pairNetwork: name, DataMatrix and Communities.
+    """
+    def __init__(self, name, number_features, number_observations, number_communities, seed=0):
+        rng = np.random.default_rng(seed)
+        self.name = name
+        self.DataMatrix = pd.DataFrame(rng.normal(size=(number_features, number_observations)),
+                                       index=['%s_%d' %(name, ii) for ii in range(number_features)],
+                                       columns=['obs_%d' %ii for ii in range(number_observations)])
+        self.Clus = rng.integers(0, number_communities, number_features)
+        self.Communities = {}
+        for ii in range(number_features):
+            self.Communities.setdefault(int(self.Clus[ii]), []).append(ii)
+
+
+def make_association(society1, society2):
+    observations = list(society1.DataMatrix.columns)
+    return {'name': society1.name + '_' + society2.name, 'timepoint1': 0, 'timepoint2': 0, 
+            'society1': society1.name, 'society2': society2.name, 'subjects': observations,
+            'observation_list_society1': observations, 'observation_list_society2': observations}
+
+
+def bench_null_modes(numPermutation=100):
+    """
+    Runtime of pairNetwork with resampling null vs. label permutation null, 
+    including the real scores, which are the same for both.
+    """
+    society1 = syntheticSociety('genes', 300, 40, 30, seed=1)
+    society2 = syntheticSociety('cells', 100, 40, 10, seed=2)
+    print("pairNetwork null modes, %d permutations, %d x %d communities" 
+          %(numPermutation, len(society1.Communities), len(society2.Communities)))
+    print("null_mode\tseconds")
+    for null_mode in ['resample', 'label']:
+        t, pn = timeit(lambda: pairNetwork(make_association(society1, society2), society1, society2, seed=0, 
+                                           numPermutation=numPermutation, null_mode=null_mode), repeat=1)
+        print("%s\t%.3f" %(null_mode, t))
+
+
+
+if __name__ == '__main__':
+    bench_pls2()
+    bench_null_modes()
+    bench_correlation_distance()
+    bench_hierachical_clustering()
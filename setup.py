@@ -40,9 +40,13 @@ setup(
     'python-igraph',
     'fuzzywuzzy',
     'pyyaml',
-    'scanpy',
   ],
 
+  # scanpy is only needed for leiden_find_communities(backend='scanpy')
+  extras_require={
+    'scanpy': ['scanpy'],
+  },
+
   python_requires='>=3',
 
   data_files=[